@@ -0,0 +1,189 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Priorities, most urgent first: a new game's first scene, a player's turn, work nobody waits on
+# (speculative branches, the opening pool, story summaries)
+OPENING = 0
+TURN = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {OPENING: "opening", TURN: "turn", BACKGROUND: "background"}
+
+SERVICE_EWMA_ALPHA = 0.2
+
+
+class LLMQueueFull(Exception):
+    """Raised by AdmissionController.acquire when too many requests are already waiting ahead."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM queue full; retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    def __init__(self, priority, grant):
+        self.priority = priority
+        self.grant = grant
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+
+class _WaitStats:
+    def __init__(self, recent=500):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=recent)
+        self.rejected = 0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def to_dict(self):
+        recent = sorted(self.recent)
+        return {
+            "admitted": self.count,
+            "rejected": self.rejected,
+            "wait_ms_avg": round(self.total / self.count * 1000, 1) if self.count else None,
+            "wait_ms_p95": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 1) if recent else None,
+            "wait_ms_max": round(self.max * 1000, 1),
+        }
+
+
+class AdmissionController:
+    """
+    Global limit on model calls in flight, with a priority queue in front of it.
+
+    Callers take a slot with acquire() (threads) or acquire_async() (the ASGI event loop) and
+    hand it back with release(). When all limit slots are busy, requests wait in one FIFO per
+    priority and freed slots go to openings first, then turns, then background work; background
+    work never holds more than background_limit slots, so players always find some free.
+
+    A request is refused with LLMQueueFull (answered with 429 and Retry-After) when max_queue
+    requests of the same or higher priority are already waiting; background requests always
+    wait. Retry-After is estimated from the queue ahead and the average time a slot is held.
+    limit=0 disables the limit (every acquire succeeds at once; waits are still counted).
+    """
+
+    def __init__(self, limit=4, max_queue=16, background_limit=None, service_seconds=5.0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.background_limit = background_limit if background_limit is not None else max(1, limit // 2)
+        self._lock = threading.Lock()
+        self._queues = {p: deque() for p in PRIORITY_NAMES}
+        self._active = 0
+        self._background_active = 0
+        self._service_seconds = service_seconds
+        self._waits = {p: _WaitStats() for p in PRIORITY_NAMES}
+
+    def _runnable(self, priority):
+        # Caller holds self._lock
+        if self.limit <= 0:
+            return True
+        if self._active >= self.limit:
+            return False
+        return priority != BACKGROUND or self._background_active < self.background_limit
+
+    def _start(self, ticket):
+        # Caller holds self._lock
+        ticket.started_at = time.monotonic()
+        self._active += 1
+        self._background_active += ticket.priority == BACKGROUND
+        self._waits[ticket.priority].add(ticket.started_at - ticket.enqueued_at)
+
+    def _retry_after(self, ahead):
+        # Caller holds self._lock
+        slots = self.limit if self.limit > 0 else 1
+        return max(1, math.ceil((ahead // slots + 1) * self._service_seconds))
+
+    def _enqueue(self, priority, grant):
+        """The ticket and whether it already holds a slot; otherwise it is queued and grant() is called later."""
+        ticket = _Ticket(priority, grant)
+        with self._lock:
+            ahead = sum(len(self._queues[p]) for p in PRIORITY_NAMES if p <= priority)
+            if ahead == 0 and self._runnable(priority):
+                self._start(ticket)
+                return ticket, True
+            if priority != BACKGROUND and ahead >= self.max_queue:
+                self._waits[priority].rejected += 1
+                raise LLMQueueFull(self._retry_after(ahead))
+            self._queues[priority].append(ticket)
+            return ticket, False
+
+    def _dispatch(self):
+        # Caller holds self._lock; starts waiting tickets while slots are free and returns them
+        started = []
+        for priority, waiting in self._queues.items():
+            while waiting and self._runnable(priority):
+                ticket = waiting.popleft()
+                self._start(ticket)
+                started.append(ticket)
+        return started
+
+    def acquire(self, priority=TURN):
+        """Block until a slot is free and return its ticket for release(); raises LLMQueueFull."""
+        ready = threading.Event()
+        ticket, started = self._enqueue(priority, ready.set)
+        if not started:
+            ready.wait()
+        return ticket
+
+    @contextmanager
+    def slot(self, priority=TURN):
+        ticket = self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    async def acquire_async(self, priority=TURN):
+        """acquire() for coroutines: waits without blocking the event loop; cancelling it gives up the place."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def resolve():
+            if not ready.done():
+                ready.set_result(None)
+
+        ticket, started = self._enqueue(priority, lambda: loop.call_soon_threadsafe(resolve))
+        if started:
+            return ticket
+        try:
+            await ready
+        except BaseException:
+            with self._lock:
+                holding = ticket.started_at is not None
+                if not holding:
+                    self._queues[priority].remove(ticket)
+            if holding:
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket):
+        with self._lock:
+            self._active -= 1
+            self._background_active -= ticket.priority == BACKGROUND
+            held = time.monotonic() - ticket.started_at
+            self._service_seconds += SERVICE_EWMA_ALPHA * (held - self._service_seconds)
+            started = self._dispatch()
+        for waiting in started:
+            waiting.grant()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "background_limit": self.background_limit,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "queued": {PRIORITY_NAMES[p]: len(q) for p, q in self._queues.items()},
+                "slot_seconds_avg": round(self._service_seconds, 2),
+                "waits": {PRIORITY_NAMES[p]: w.to_dict() for p, w in self._waits.items()},
+            }
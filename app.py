@@ -1,16 +1,38 @@
-from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response
+from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response, stream_with_context, send_file, abort
 import webbrowser
-import threading
 import os
+import random
 import re
 import json
+import shutil
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-import ollama
 from game.player import Player
-from generate_images import generate_image_from_text, sanitize_filename as image_png_filename
+from game.ai import FakeBackend, LLMPool, OllamaBackend
+from game.context import ContextWindow
+from game.engine import STORY_SCHEMA, SceneJSONParser, parse_cache_stats, parse_scene, structured_reply_text
+from llm_stats import OllamaTimings, SceneFormatStats
+from llm_cache import ResponseCache, cache_key
+from generate_images import generate_image_from_text, comfyui_health, sanitize_filename as image_png_filename
+from image_store import ImageResultStore
+from history_store import StaleHistory, create_history_store
+from session_locks import SessionLocks
+from speculation import Speculator
+from admission import AdmissionController, LLMQueueFull, OPENING, TURN, BACKGROUND
+from opening_pool import OpeningPool
+from image_similarity import PromptImageIndex
+from image_jobs import ImageJobScheduler, ImageQueueFull, REJECTED
+from compress_images import VARIANTS as IMAGE_VARIANT_WIDTHS, compress_new_image, variant_path
 
 TARGET_DIR = r"C:\Users\nirca\repos\rpg_dungeon_ai\static\images"
+# ComfyUI cost profile for in-game scene images (see workflows.COST_PROFILES); "fast" cuts latency
+IMAGE_PROFILE = os.environ.get("FABLES_IMAGE_PROFILE", "quality")
+# Build WebP/AVIF size variants (static/images/variants) after each scene image is generated
+IMAGE_VARIANTS = os.environ.get("FABLES_IMAGE_VARIANTS", "1") == "1"
+VARIANT_DIR = os.path.join(TARGET_DIR, "variants")
 
 # Start-place options: id, label, image path (under static/images), and initial prompt for the story
 START_OPTIONS = [
@@ -106,71 +128,273 @@ def inject_soundtrack_url():
     return {"soundtrack_music_url": url_for("static", filename=rel) if rel else None}
 
 
-MAX_HISTORY = 6
-
 def open_browser():
     webbrowser.open_new("http://127.0.0.1:5000/")
 
 # === Text Utilities ===
-def strip_markdown_bold(text):
-    return re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-
-def remove_options_text(text):
-    """Remove numbered options lines from AI output"""
-    return "\n".join(
-        line for line in text.splitlines() 
-        if not re.match(r'^\s*\d+[\.\)\-]', line)
-    ).strip()
-
+# Replies are parsed once per distinct text (game.engine.parse_scene is memoized), so these are lookups.
 def extract_options(ai_text):
-    """Extract numbered options from AI output"""
-    options = {}
-    pattern = re.compile(r'^\s*(\d+)[\.\)\-]\s*(.*)$')
-    for line in ai_text.splitlines():
-        match = pattern.match(line)
-        if match:
-            num = int(match.group(1))
-            text = match.group(2).strip()
-            text = strip_markdown_bold(text)
-            options[num] = text
-    return options
+    """Numbered options from AI output (a copy: the parsed scene is shared)."""
+    return dict(parse_scene(ai_text).options)
 
 
 def extract_chapter_title(ai_text):
-    """Last non-empty line must be 'Chapter: <short name>' (see system prompt)."""
-    if not ai_text:
-        return None
-    for line in reversed(ai_text.strip().splitlines()):
-        line = line.strip()
-        if not line:
-            continue
-        m = re.match(r"^Chapter:\s*(.+)$", line, re.IGNORECASE)
-        if m:
-            title = m.group(1).strip().rstrip(".").strip()
-            return (title[:100] if title else None)
-    return None
-
-
-def _strip_trailing_chapter_lines(text):
-    lines = text.strip().splitlines()
-    while lines and re.match(r"^\s*Chapter:\s*.+$", lines[-1], re.IGNORECASE):
-        lines.pop()
-    return "\n".join(lines).strip()
+    """Title from the 'Chapter: <short name>' line that ends the reply (see system prompt)."""
+    return parse_scene(ai_text).chapter_title
 
 
 def clean_scene_text(text):
     """Remove unwanted 'Scene:' prefixes, options, chapter metadata, and extra whitespace"""
-    if not text:
-        return ""
-    text = strip_markdown_bold(remove_options_text(text))
-    text = _strip_trailing_chapter_lines(text)
-    text = re.sub(r'^\s*scene\s*[:\-]\s*', '', text, flags=re.IGNORECASE)
-    return text.strip()
+    return parse_scene(text).scene_text
 
 # === Ollama AI response ===
-def generate_response(history):
-    response = ollama.chat(model='llama3:latest', messages=history)
-    return response['message']['content']
+OLLAMA_MODEL = os.environ.get("FABLES_OLLAMA_MODEL", "llama3:latest")
+# Keep the model loaded between turns. The options are the same on every call: a different num_ctx
+# makes Ollama reload the model and drop its prompt cache.
+OLLAMA_KEEP_ALIVE = os.environ.get("FABLES_OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_OPTIONS = {
+    "num_ctx": int(os.environ.get("FABLES_OLLAMA_NUM_CTX", "4096")),
+    "num_predict": int(os.environ.get("FABLES_OLLAMA_NUM_PREDICT", "512")),
+}
+# FABLES_OLLAMA_LOG_TIMINGS=1 prints prompt-eval vs eval time for every call
+ollama_timings = OllamaTimings(log=os.environ.get("FABLES_OLLAMA_LOG_TIMINGS") == "1")
+# FABLES_OLLAMA_HOSTS=http://gpu1:11434,http://gpu2:11434 spreads calls over several Ollama servers
+# (default: OLLAMA_HOST or the local one). FABLES_LLM_BACKEND=fake answers with canned scenes instead.
+OLLAMA_HOSTS = [h.strip() for h in os.environ.get("FABLES_OLLAMA_HOSTS", "").split(",") if h.strip()] or [None]
+OLLAMA_TIMEOUT = float(os.environ.get("FABLES_OLLAMA_TIMEOUT", "120"))
+if os.environ.get("FABLES_LLM_BACKEND") == "fake":
+    llm = LLMPool([FakeBackend(delay=float(os.environ.get("FABLES_FAKE_LLM_DELAY", "0")))])
+else:
+    llm = LLMPool(
+        [OllamaBackend(host, timeout=OLLAMA_TIMEOUT) for host in OLLAMA_HOSTS],
+        health_interval=float(os.environ.get("FABLES_OLLAMA_HEALTH_INTERVAL", "10")),
+    )
+# At most FABLES_LLM_CONCURRENCY model calls in flight (default 4 per Ollama server); the rest wait by
+# priority (openings, then turns, then background work). A player with FABLES_LLM_QUEUE requests already
+# waiting ahead gets 429 and Retry-After instead of an ever longer wait. 0 disables the limit.
+admission = AdmissionController(
+    limit=int(os.environ.get("FABLES_LLM_CONCURRENCY", str(4 * len(OLLAMA_HOSTS)))),
+    max_queue=int(os.environ.get("FABLES_LLM_QUEUE", "16")),
+)
+# Reply cache (FABLES_LLM_CACHE=1): a prompt seen before (same model, options and messages, e.g. the opening
+# of a setup or a replayed evaluation run) is answered from llm_cache.jsonl instead of the model.
+# FABLES_LLM_CACHE_VARIANTS=K keeps K different replies per prompt and picks one at random for variety.
+LLM_CACHE_FILE = os.environ.get(
+    "FABLES_LLM_CACHE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.jsonl")
+)
+llm_cache = (
+    ResponseCache(
+        path=LLM_CACHE_FILE,
+        max_entries=int(os.environ.get("FABLES_LLM_CACHE_SIZE", "1000")),
+        ttl_seconds=float(os.environ.get("FABLES_LLM_CACHE_TTL", str(7 * 24 * 3600))),
+        variants=int(os.environ.get("FABLES_LLM_CACHE_VARIANTS", "1")),
+    )
+    if os.environ.get("FABLES_LLM_CACHE") == "1"
+    else None
+)
+
+
+# Story reply format: "text" (numbered options and a Chapter: line, found with regexes), "json" (Ollama's
+# `format` constrained to STORY_SCHEMA, streamed through SceneJSONParser, text parser as fallback), or "ab"
+# (each call picks one at random, to compare how often replies come out unusable: scene_format in /metrics).
+STORY_FORMAT = os.environ.get("FABLES_STORY_FORMAT", "text")
+STORY_JSON_INSTRUCTION = (
+    " Instead of numbered lines and a Chapter line, reply with JSON only: "
+    '{"scene": the scene description, "options": the 2 or 3 choices without numbers, '
+    '"chapter": the short chapter title without the word Chapter}.'
+)
+scene_format_stats = SceneFormatStats()
+
+
+def _cache_key(messages):
+    return cache_key(OLLAMA_MODEL, OLLAMA_OPTIONS, messages) if llm_cache else None
+
+
+def _story_mode(story):
+    if not story:
+        return None
+    if STORY_FORMAT == "ab":
+        return random.choice(("text", "json"))
+    return "json" if STORY_FORMAT == "json" else "text"
+
+
+def _story_request(history, mode):
+    """Messages and Ollama format for a call; in json mode earlier replies are shown to the model as JSON too."""
+    if mode != "json":
+        return history, None
+    messages = []
+    for m in history:
+        if m["role"] == "system" and not messages:
+            m = {"role": "system", "content": m["content"] + STORY_JSON_INSTRUCTION}
+        elif m["role"] == "assistant":
+            parsed = parse_scene(m["content"])
+            reply = {
+                "scene": parsed.scene_text,
+                "options": [parsed.options[n] for n in sorted(parsed.options)],
+                "chapter": parsed.chapter_title or "",
+            }
+            m = {"role": "assistant", "content": json.dumps(reply, ensure_ascii=False)}
+        messages.append(m)
+    return messages, STORY_SCHEMA
+
+
+def _story_reply(mode, raw, parser=None):
+    """The reply as kept in history (always the plain-text layout); records how usable it was."""
+    if mode is None:
+        return raw
+    how = None
+    text = raw
+    if mode == "json":
+        if parser is None:
+            parser = SceneJSONParser()
+            parser.feed(raw)
+        text, how = structured_reply_text(parser, raw)
+    scene_format_stats.record(mode, parse_scene(text), how)
+    return text
+
+
+def generate_response(history, story=True):
+    """The storyteller's reply to history (story=False for other prompts, e.g. summaries: always plain text)."""
+    mode = _story_mode(story)
+    messages, output_format = _story_request(history, mode)
+    key = _cache_key(messages)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        return cached
+    started = time.monotonic()
+    response = llm.chat(
+        model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE,
+        format=output_format,
+    )
+    ollama_timings.record(response, messages)
+    text = _story_reply(mode, response['message']['content'])
+    if key:
+        llm_cache.put(key, text, time.monotonic() - started)
+    return text
+
+
+def generate_response_stream(history, story=True):
+    """
+    Yield content deltas as Ollama produces them (same model/messages as generate_response). In json
+    mode the scene is yielded as it is decoded and the options and chapter line follow at the end,
+    so the deltas always add up to the plain-text reply.
+    """
+    mode = _story_mode(story)
+    messages, output_format = _story_request(history, mode)
+    key = _cache_key(messages)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        yield cached
+        return
+    parser = SceneJSONParser() if mode == "json" else None
+    started = time.monotonic()
+    parts = []
+    shown = []
+    for chunk in llm.chat(
+        model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE,
+        format=output_format, stream=True,
+    ):
+        delta = chunk['message']['content']
+        if delta:
+            parts.append(delta)
+            if parser is None:
+                yield delta
+            else:
+                scene = parser.feed(delta)
+                if scene:
+                    shown.append(scene)
+                    yield scene
+        if chunk.get('done'):
+            ollama_timings.record(chunk, messages)
+            text = _story_reply(mode, "".join(parts), parser)
+            if parser is not None:
+                yield _story_rest(text, "".join(shown))
+            if key:
+                llm_cache.put(key, text, time.monotonic() - started)
+
+
+def _story_rest(text, shown):
+    """What follows the scene text already streamed from a json reply (all of text if it was not JSON)."""
+    return text[len(shown):] if text.startswith(shown) else text
+
+
+def _background_response(history, story=True):
+    """generate_response for work no player is waiting on (opening pool, summaries): lowest priority."""
+    with admission.slot(BACKGROUND):
+        return generate_response(history, story)
+
+
+def _background_stream(history, begin=None):
+    """
+    generate_response_stream at background priority (speculative branches); the slot is held while
+    it streams. begin() is called once the slot is granted; if it returns False nothing is generated.
+    """
+    with admission.slot(BACKGROUND):
+        if begin is not None and not begin():
+            return
+        yield from generate_response_stream(history)
+
+
+class SceneStreamFilter:
+    """
+    Turn raw streamed assistant text into displayable scene text as it arrives.
+    Numbered option lines and the trailing 'Chapter:' line are held back; the final
+    clean_scene_text() result sent at the end of the stream is authoritative.
+    """
+
+    _HOLD_BACK = re.compile(r'^\s*(\d|chapter\b)', re.IGNORECASE)
+    _SCENE_PREFIX = re.compile(r'^\s*scene\s*[:\-]\s*', re.IGNORECASE)
+
+    def __init__(self):
+        self._line = ""
+        self._line_emitted = 0
+        self._line_visible = None
+        self._started = False
+
+    def _visible(self, line):
+        return not self._HOLD_BACK.match(line)
+
+    def _emit_line_part(self, upto_end):
+        """Return the not-yet-emitted part of the current line if it is known to be scene text."""
+        if self._line_visible is None:
+            stripped = self._line.lstrip()
+            # Wait until enough of the line is known to tell a scene line from an option/chapter line.
+            if not upto_end and len(stripped) < 8:
+                return ""
+            self._line_visible = bool(stripped) and self._visible(self._line)
+            prefix = self._SCENE_PREFIX.match(self._line) if not self._started else None
+            if prefix:
+                self._line_emitted = prefix.end()
+        if not self._line_visible:
+            return ""
+        part = self._line[self._line_emitted:]
+        # Keep trailing '*' back until it is known whether they form a '**' bold marker.
+        if not upto_end:
+            part = part.rstrip("*")
+        self._line_emitted += len(part)
+        part = part.replace("**", "")
+        if not self._started:
+            part = part.lstrip()
+            self._started = bool(part)
+        return part
+
+    def feed(self, delta):
+        out = []
+        for piece in re.split(r'(\n)', delta):
+            if piece == "\n":
+                text = self._emit_line_part(upto_end=True)
+                if text:
+                    out.append(text)
+                if self._line_visible and self._started:
+                    out.append("\n")
+                self._line, self._line_emitted, self._line_visible = "", 0, None
+            elif piece:
+                self._line += piece
+                out.append(self._emit_line_part(upto_end=False))
+        return "".join(out)
+
+    def flush(self):
+        return self._emit_line_part(upto_end=True)
 
 # === Image Utilities ===
 # On-disk PNG names must match generate_images.sanitize_filename (MD5 suffix), not a plain truncated string.
@@ -209,41 +433,156 @@ def get_scene_image(scene_text):
     fname = image_png_filename(enhanced_prompt)
     cached_image_path = os.path.join(TARGET_DIR, fname)
     if not os.path.exists(cached_image_path):
-        return generate_image_from_text(enhanced_prompt)
+        return generate_image_from_text(enhanced_prompt, workflow="fables", profile=IMAGE_PROFILE)
     else:
         return f"/static/images/{fname}"
 
-pending_images = {}
+# Scene image job per (browser session, scene id); bounded by entry count and idle TTL.
+image_results = ImageResultStore(max_entries=2048, ttl_seconds=3600)
+# Fixed worker pool in front of ComfyUI; identical prompts share one in-flight generation.
+# Variant encoding runs on its own thread so image workers go straight back to ComfyUI jobs.
+variant_builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-variants")
+variant_sources_pending = set()
+variant_sources_lock = threading.Lock()
+
+
+def _build_variants(source):
+    """Queue variant encoding for a scene image unless it is already queued or running."""
+    with variant_sources_lock:
+        if source in variant_sources_pending:
+            return
+        variant_sources_pending.add(source)
+    future = variant_builder.submit(compress_new_image, source, VARIANT_DIR)
+
+    def done(_future):
+        with variant_sources_lock:
+            variant_sources_pending.discard(source)
+
+    future.add_done_callback(done)
+
+
+# Near-duplicate image reuse (FABLES_IMAGE_SIMILARITY=<threshold>, e.g. 0.8): a scene whose prompt is that
+# close (TF-IDF cosine) to an already generated one gets that image instead of a new diffusion run.
+IMAGE_SIMILARITY = os.environ.get("FABLES_IMAGE_SIMILARITY", "")
+image_index = (
+    PromptImageIndex(os.path.join(TARGET_DIR, "prompt_index.jsonl"), float(IMAGE_SIMILARITY))
+    if IMAGE_SIMILARITY
+    else None
+)
+
+
+def _similar_scene_image(prompt):
+    """
+    URL of an existing image for a near-duplicate prompt, linked under this prompt's own cache
+    name so later exact lookups (page reloads, exports) find it; None if nothing is close enough.
+    """
+    match = image_index.match(prompt)
+    if match is None:
+        return None
+    fname = image_png_filename(prompt)
+    target = os.path.join(TARGET_DIR, fname)
+    try:
+        os.link(os.path.join(TARGET_DIR, match), target)
+    except FileExistsError:
+        pass
+    except OSError:
+        try:
+            shutil.copyfile(os.path.join(TARGET_DIR, match), target)
+        except OSError as e:
+            print(f"Could not reuse similar scene image {match}, generating instead: {e}")
+            return None
+    print(f"Reusing similar scene image {match} for: {prompt[:50]}...")
+    return f"/static/images/{fname}"
+
+
+def _generate_scene_image(prompt):
+    image_url = None
+    exact = os.path.exists(os.path.join(TARGET_DIR, image_png_filename(prompt)))
+    if image_index is not None and not exact:
+        image_url = _similar_scene_image(prompt)
+    if image_url is None:
+        started = time.monotonic()
+        image_url = generate_image_from_text(prompt, workflow="fables", profile=IMAGE_PROFILE)
+        if image_url and image_index is not None and not exact:
+            image_index.add(prompt, os.path.basename(image_url), time.monotonic() - started)
+    if image_url and IMAGE_VARIANTS:
+        _build_variants(os.path.join(TARGET_DIR, os.path.basename(image_url)))
+    return image_url
+
+
+image_jobs = ImageJobScheduler(_generate_scene_image, workers=2, max_queue=64)
+
+
+def _speculate_image(branch):
+    """Queue a speculative branch's scene image too, but only while the image queue is mostly empty."""
+    stats = image_jobs.stats()
+    if stats["queued"] >= stats["max_queue"] // 4:
+        return False
+    try:
+        image_jobs.submit(enhance_image_prompt(clean_scene_text(branch.text)))
+    except ImageQueueFull:
+        return False
+    return True
+
+
+# Speculative turns (FABLES_SPECULATE=1): after each scene, write the reply to every offered option in
+# the background so a clicked option is served without waiting on Ollama; unpicked branches are cancelled.
+# Costs up to 3x the model time per turn; FABLES_SPECULATE_IMAGES=1 also renders the branches' images.
+SPECULATE = os.environ.get("FABLES_SPECULATE", "0") == "1"
+SPECULATE_IMAGES = os.environ.get("FABLES_SPECULATE_IMAGES", "0") == "1"
+# Longest a turn waits for a branch that is still being written before generating the reply itself
+SPECULATE_WAIT = float(os.environ.get("FABLES_SPECULATE_WAIT", "30"))
+speculator = (
+    Speculator(
+        _background_stream,
+        on_ready=_speculate_image if SPECULATE_IMAGES else None,
+        workers=int(os.environ.get("FABLES_SPECULATE_WORKERS", "2")),
+    )
+    if SPECULATE
+    else None
+)
 
 EVAL_EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_exports")
 
 # Conversation history is stored server-side: cookie size (~4KB) truncates long games otherwise.
-SERVER_HISTORY_LOCK = threading.Lock()
-SERVER_HISTORIES: dict[str, list] = {}
+# "memory" (default, lost on restart) or "sqlite:///path.db" to share it across workers and deploys.
+HISTORY_STORE = os.environ.get("FABLES_HISTORY_STORE", "memory")
+history_store = create_history_store(HISTORY_STORE)
+# One in-flight turn per game: a second request for the same session is rejected, other games never wait.
+session_locks = SessionLocks()
 
 
 def _release_server_history():
     key = session.get("_history_key")
     if key:
-        with SERVER_HISTORY_LOCK:
-            SERVER_HISTORIES.pop(key, None)
+        history_store.delete(key)
+        image_results.discard_session(key)
+        if speculator is not None:
+            speculator.discard(key)
+        context_window.discard(key)
 
 
-def _game_history() -> list:
-    """Mutable chat history for this browser session; not stored in the signed cookie."""
+def _history_key() -> str:
     if "_history_key" not in session:
         session["_history_key"] = str(uuid.uuid4())
         session.modified = True
-    key = session["_history_key"]
-    with SERVER_HISTORY_LOCK:
-        if key not in SERVER_HISTORIES:
-            legacy = session.pop("history", None)
-            if isinstance(legacy, list) and legacy:
-                SERVER_HISTORIES[key] = legacy
-                session.modified = True
-            else:
-                SERVER_HISTORIES[key] = []
-        return SERVER_HISTORIES[key]
+    return session["_history_key"]
+
+
+def _game_history() -> list:
+    """
+    Copy of the chat history for this browser session (not stored in the signed cookie).
+    Persist changes with history_store.append()/replace(); mutating the list does not.
+    """
+    key = _history_key()
+    history = history_store.load(key)
+    if not history:
+        legacy = session.pop("history", None)
+        if isinstance(legacy, list) and legacy:
+            history_store.replace(key, legacy)
+            session.modified = True
+            history = list(legacy)
+    return history
 
 
 def _build_session_export_payload():
@@ -262,9 +601,9 @@ def _build_session_export_payload():
     for idx, msg in enumerate(history):
         if msg.get("role") != "assistant":
             continue
-        assistant_content = msg["content"]
-        scene_text = clean_scene_text(assistant_content)
-        options = extract_options(assistant_content)
+        parsed = parse_scene(msg["content"])
+        scene_text = parsed.scene_text
+        options = dict(parsed.options)
         enhanced = enhance_image_prompt(scene_text)
         fname = image_png_filename(enhanced)
         fpath = os.path.join(TARGET_DIR, fname)
@@ -279,6 +618,7 @@ def _build_session_export_payload():
             "image_filename": fname,
             "image_on_disk": bool(image_rel),
             "image_generation_prompt_used": enhanced,
+            "parse_warnings": list(parsed.warnings),
         }
         if idx >= 1 and history[idx - 1].get("role") == "user":
             if idx <= 2:
@@ -304,14 +644,16 @@ def _build_session_export_payload():
     }
 
 
-def generate_image_async(scene_text, scene_id):
+def start_scene_image(scene_text, session_key, scene_id):
+    """Queue image generation for a scene and record its job so /get_image can report status."""
+    enhanced_prompt = enhance_image_prompt(scene_text)
     try:
-        enhanced_prompt = enhance_image_prompt(scene_text)
-        image_url = generate_image_from_text(enhanced_prompt)
-        pending_images[scene_id] = image_url
-    except Exception as e:
-        print(f"Error generating image: {e}")
-        pending_images[scene_id] = None
+        job = image_jobs.submit(enhanced_prompt)
+    except ImageQueueFull as e:
+        print(f"Skipping scene image: {e}")
+        job = None
+    image_results.put(session_key, scene_id, job)
+    return job
 
 # === Routes ===
 @app.route("/restart", methods=["GET"])
@@ -342,6 +684,9 @@ def _get_fables_system_prompt():
 
 @app.route("/", methods=["GET"])
 def index():
+    if opening_pool is not None:
+        # Fill the pool while the first players are still choosing their setup
+        opening_pool.start()
     start_id = request.args.get("start", "").strip().lower()
     character_id = request.args.get("character", "").strip().lower()
     companion_id = request.args.get("companion", "").strip().lower()
@@ -413,36 +758,20 @@ def index():
         _release_server_history()
         session.clear()
     if "player" not in session:
-        session["player"] = Player().__dict__
-        h = _game_history()
-        h.clear()
-
-        prompt_for_start = next((o["initial_prompt"] for o in START_OPTIONS if o["id"] == start_id), START_OPTIONS[0]["initial_prompt"])
-        character_line = "The young hero is a boy. " if character_id == "boy" else "The young hero is a girl. "
-        companion_line = "The hero has a friendly dog as a companion. " if companion_id == "dog" else "The hero has a friendly cat as a companion. "
-        user_prompt = character_line + companion_line + prompt_for_start
-        fables_intro = {"role": "system", "content": _get_fables_system_prompt()}
-        h.append(fables_intro)
-        h.append({"role": "user", "content": user_prompt})
+        h = _opening_messages(start_id, character_id, companion_id)
         try:
-            ai_intro_response = generate_response(h)
+            ai_intro_response = _pooled_opening(start_id, character_id, companion_id)
+            if not ai_intro_response:
+                with admission.slot(OPENING):
+                    ai_intro_response = generate_response(h)
+        except LLMQueueFull as e:
+            return _llm_busy_page(e)
         except ConnectionError:
             return render_template("ollama_error.html")
-        h.append({"role": "assistant", "content": ai_intro_response})
-        session["story_chapter_index"] = 1
-        ch1 = extract_chapter_title(ai_intro_response)
-        session["player_status"] = (
-            f"Story: Chapter 1 — {ch1}" if ch1 else "Story: Chapter 1 — Your tale has begun"
-        )
-        session["setup"] = {
-            "start": start_id,
-            "character": character_id,
-            "companion": companion_id,
-        }
-        session.modified = True
+        _begin_game(h, ai_intro_response, start_id, character_id, companion_id)
 
     h = _game_history()
-    # History lives in RAM; after a server restart the cookie may still have "player" but h is empty.
+    # With the in-memory history store a server restart (or eviction) leaves the cookie with "player" but h empty.
     if not h:
         session.clear()
         return redirect(
@@ -457,21 +786,24 @@ def index():
     if h[-1].get("role") != "assistant":
         return render_template("ollama_error.html")
     last_ai_msg = h[-1]["content"]
-    scene_text = clean_scene_text(last_ai_msg)
-    options = extract_options(last_ai_msg)
+    parsed = parse_scene(last_ai_msg)
+    scene_text = parsed.scene_text
+    options = dict(parsed.options)
+    # Streamed turns cannot rewrite the cookie after the title is known, so derive it from history.
+    session["player_status"] = _chapter_status(session.get("story_chapter_index", 1), last_ai_msg)
 
     enhanced = enhance_image_prompt(scene_text)
     image_fname = image_png_filename(enhanced)
     cached_image_path = os.path.join(TARGET_DIR, image_fname)
     if os.path.exists(cached_image_path):
         scene_image_url = f"/static/images/{image_fname}"
+        scene_image_srcset = scene_image_srcset_for(scene_image_url)
         initial_scene_id = None
     else:
         scene_image_url = ""
+        scene_image_srcset = ""
         initial_scene_id = "scene_initial"
-        thread = threading.Thread(target=generate_image_async, args=(scene_text, initial_scene_id))
-        thread.daemon = True
-        thread.start()
+        start_scene_image(scene_text, session["_history_key"], initial_scene_id)
 
     return render_template(
         "game.html",
@@ -482,94 +814,551 @@ def index():
         options=options,
         player_status=session["player_status"],
         scene_image=scene_image_url,
+        scene_image_srcset=scene_image_srcset,
         initial_scene_id=initial_scene_id,
+        initial_turn=len(h),
+        image_push=IMAGE_PUSH,
+    )
+
+def _new_game_setup():
+    """(start, character, companion) when this / request opens a new game (valid setup, no game in the session), else None."""
+    start_id = request.args.get("start", "").strip().lower()
+    character_id = request.args.get("character", "").strip().lower()
+    companion_id = request.args.get("companion", "").strip().lower()
+    if "player" in session:
+        return None
+    if start_id in START_IDS and character_id in CHARACTER_IDS and companion_id in COMPANION_IDS:
+        return start_id, character_id, companion_id
+    return None
+
+
+def _opening_messages(start_id, character_id, companion_id):
+    """System prompt and setup message that open a new game."""
+    prompt_for_start = next((o["initial_prompt"] for o in START_OPTIONS if o["id"] == start_id), START_OPTIONS[0]["initial_prompt"])
+    character_line = "The young hero is a boy. " if character_id == "boy" else "The young hero is a girl. "
+    companion_line = "The hero has a friendly dog as a companion. " if companion_id == "dog" else "The hero has a friendly cat as a companion. "
+    user_prompt = character_line + companion_line + prompt_for_start
+    return [
+        {"role": "system", "content": _get_fables_system_prompt()},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _begin_game(h, ai_intro_response, start_id, character_id, companion_id):
+    """Store the opening turn and the new game's session state (h: _opening_messages())."""
+    session["player"] = Player().__dict__
+    h.append({"role": "assistant", "content": ai_intro_response})
+    history_store.replace(_history_key(), h)
+    _speculate_turn(session["_history_key"], h, extract_options(ai_intro_response))
+    session["story_chapter_index"] = 1
+    session["player_status"] = _chapter_status(1, ai_intro_response)
+    session["setup"] = {
+        "start": start_id,
+        "character": character_id,
+        "companion": companion_id,
+    }
+    session.modified = True
+
+
+def _warm_opening_image(text):
+    """Render a pooled opening's scene image ahead of time (blocks the pool thread until it is done)."""
+    try:
+        job = image_jobs.submit(enhance_image_prompt(clean_scene_text(text)))
+    except ImageQueueFull:
+        return
+    finished = threading.Event()
+    image_jobs.add_done_callback(job, lambda _job: finished.set())
+    finished.wait(OPENING_IMAGE_TIMEOUT)
+
+
+# Warm pool of opening scenes (FABLES_OPENING_POOL=N keeps N per setup, text and image, 16 setups):
+# a new game then starts from a pooled opening instead of a cold Ollama call and image generation.
+OPENING_POOL_SIZE = int(os.environ.get("FABLES_OPENING_POOL", "0"))
+OPENING_POOL_FILE = os.environ.get(
+    "FABLES_OPENING_POOL_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "opening_pool.json")
+)
+OPENING_IMAGE_TIMEOUT = 300
+opening_pool = (
+    OpeningPool(
+        lambda messages: _background_response(messages),
+        {
+            f"{s['id']}/{c['id']}/{p['id']}": _opening_messages(s["id"], c["id"], p["id"])
+            for s in START_OPTIONS
+            for c in CHARACTER_OPTIONS
+            for p in COMPANION_OPTIONS
+        },
+        per_combo=OPENING_POOL_SIZE,
+        warm=_warm_opening_image,
+        path=OPENING_POOL_FILE,
+    )
+    if OPENING_POOL_SIZE > 0
+    else None
+)
+
+
+def _pooled_opening(start_id, character_id, companion_id):
+    """A pre-written opening scene for this setup, or None (pool disabled or empty)."""
+    if opening_pool is None:
+        return None
+    return opening_pool.take(f"{start_id}/{character_id}/{companion_id}")
+
+
+def _chapter_status(chapter_index, ai_text):
+    """Player status line for a chapter number and the assistant text that opened it."""
+    title = extract_chapter_title(ai_text)
+    if chapter_index <= 1:
+        return f"Story: Chapter 1 — {title}" if title else "Story: Chapter 1 — Your tale has begun"
+    return f"Story: Chapter {chapter_index} — {title}" if title else f"Story: Chapter {chapter_index}"
+
+
+def _session_lost_response():
+    return (
+        jsonify(
+            {
+                "error": "session_lost",
+                "message": "Story session expired (e.g. server restarted). Refresh the page to continue.",
+            }
+        ),
+        410,
+    )
+
+
+def _ollama_down_response():
+    return jsonify({"error": "ollama", "message": "Ollama is not running. Start Ollama or run launch_rpg_dungeon.bat, then retry."}), 503
+
+
+def _llm_busy_response(error):
+    response = jsonify(
+        {
+            "error": "busy",
+            "message": "Lots of stories are being written right now. Please try again in a moment.",
+            "retry_after": error.retry_after,
+        }
+    )
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def _llm_busy_page(error):
+    """429 for the opening page; browsers honour Refresh and reload it after Retry-After."""
+    return Response(
+        "Lots of stories are being written right now. This page will try again in a moment.",
+        status=429,
+        mimetype="text/plain",
+        headers={"Retry-After": str(error.retry_after), "Refresh": str(error.retry_after)},
+    )
+
+
+def _turn_busy_response():
+    return (
+        jsonify(
+            {
+                "error": "turn_in_progress",
+                "message": "Your last choice is still being written. Please wait for it.",
+            }
+        ),
+        409,
     )
 
-@app.route("/make_choice", methods=["POST"])
-def make_choice():
-    data = request.get_json()
-    choice_num = data.get('choice')
-    free_text = data.get('free_text', "").strip()
 
+def _load_turn(data):
+    """
+    Current history and the player's message for a turn request (call with the session lock held).
+    Returns (h, player_text, None) or (None, None, error_response).
+    """
+    if not isinstance(data, dict):
+        return None, None, (jsonify({"error": "invalid_request", "message": "Expected a JSON object."}), 400)
     h = _game_history()
     if not h or h[-1].get("role") != "assistant":
-        return (
-            jsonify(
-                {
-                    "error": "session_lost",
-                    "message": "Story session expired (e.g. server restarted). Refresh the page to continue.",
-                }
-            ),
-            410,
-        )
-    last_ai_msg = h[-1]["content"]
-    options = extract_options(last_ai_msg)
+        return None, None, _session_lost_response()
+    # The client echoes the turn it is answering; anything else is a stale or duplicate submission.
+    turn = data.get("turn")
+    if turn is not None and str(turn) != str(len(h)):
+        return None, None, _stale_turn_response()
+    player_text, invalid = _player_turn_text(data, h[-1]["content"])
+    if invalid is not None:
+        return None, None, invalid
+    return h, player_text, None
+
+
+STALE_TURN_MESSAGE = "The story has moved on. Refresh the page to continue."
+
+
+def _stale_turn_response():
+    return jsonify({"error": "stale_turn", "message": STALE_TURN_MESSAGE}), 409
+
+
+def _player_turn_text(data, last_ai_msg):
+    """
+    Resolve the player's input (free text or numbered option) to the user message text.
+    Returns (text, None) or (None, invalid_input_response).
+    """
+    choice_num = data.get('choice')
+    free_text = (data.get('free_text') or "").strip()
 
     # User typed free text
     if free_text:
-        h.append({'role': 'user', 'content': free_text})
-        try:
-            ai_response = generate_response(h[-(MAX_HISTORY + 2) :])
-        except ConnectionError:
-            return jsonify({"error": "ollama", "message": "Ollama is not running. Start Ollama or run launch_rpg_dungeon.bat, then retry."}), 503
-        h.append({'role': 'assistant', 'content': ai_response})
+        return free_text, None
 
     # User clicked numbered option
-    elif choice_num and str(choice_num).isdigit():
-        choice_num = int(choice_num)
-        player_choice_text = options.get(choice_num)
-
+    if choice_num and str(choice_num).isdigit():
+        player_choice_text = extract_options(last_ai_msg).get(int(choice_num))
         if player_choice_text:
-            h.append({'role': 'user', 'content': player_choice_text})
-            try:
-                ai_response = generate_response(h[-(MAX_HISTORY + 2) :])
-            except ConnectionError:
-                return jsonify({"error": "ollama", "message": "Ollama is not running. Start Ollama or run launch_rpg_dungeon.bat, then retry."}), 503
-            h.append({'role': 'assistant', 'content': ai_response})
-        else:
-            return jsonify({
-                "scene": "Invalid choice!",
-                "options": {},
-                "player_status": session.get('player_status', ''),
-                "scene_id": None
-            })
-    else:
-        return jsonify({
-            "scene": "Invalid input!",
+            return player_choice_text, None
+        return None, jsonify({
+            "scene": "Invalid choice!",
             "options": {},
             "player_status": session.get('player_status', ''),
             "scene_id": None
         })
+    return None, jsonify({
+        "scene": "Invalid input!",
+        "options": {},
+        "player_status": session.get('player_status', ''),
+        "scene_id": None
+    })
 
-    nxt = session.get("story_chapter_index", 1) + 1
-    session["story_chapter_index"] = nxt
-    ch_title = extract_chapter_title(ai_response)
-    session["player_status"] = (
-        f"Story: Chapter {nxt} — {ch_title}" if ch_title else f"Story: Chapter {nxt}"
-    )
-    session.modified = True
 
-    scene_text = clean_scene_text(ai_response)
-    options = extract_options(ai_response)
+def _summarize_story(previous, messages):
+    """Model-written rolling summary: fold the turns in messages into the previous summary."""
+    turns = "\n\n".join(f"{m['role']}: {clean_scene_text(m['content']) if m['role'] == 'assistant' else m['content']}"
+                        for m in messages)
+    return _background_response([
+        {"role": "system", "content": (
+            "You keep the running summary of a children's story. Reply with the updated summary only: "
+            "at most 120 words, past tense, naming the characters, places, items and promises that matter later."
+        )},
+        {"role": "user", "content": f"Summary so far: {previous or '(the story has just begun)'}\n\nWhat happened next:\n{turns}"},
+    ], story=False)
+
+
+# Prompt window per turn: system prompt and opening setup always included, then a summary of older turns
+# and the latest turns within FABLES_CONTEXT_TOKENS (estimated), so prompt size stays flat in long games.
+# FABLES_CONTEXT_SUMMARY=model has the model rewrite the summary in the background (default: extractive).
+CONTEXT_TOKENS = int(os.environ.get("FABLES_CONTEXT_TOKENS", "1536"))
+context_window = ContextWindow(
+    max_tokens=CONTEXT_TOKENS,
+    clean_text=lambda text: clean_scene_text(text),
+    summarize=_summarize_story if os.environ.get("FABLES_CONTEXT_SUMMARY") == "model" else None,
+)
+
+
+def _turn_messages(h, player_text):
+    """Messages sent to the model for the player's next message (see context_window)."""
+    return context_window.build(h, player_text, key=session.get("_history_key"))
+
+
+def _speculate_turn(key, h, options):
+    """Start speculative replies for the options just offered (no-op unless FABLES_SPECULATE=1)."""
+    if speculator is not None and options:
+        speculator.start(key, len(h), {text: _turn_messages(h, text) for text in options.values()})
+
+
+def _speculated_reply(key, h, player_text):
+    """Reply prepared for this exact turn and message (waits up to SPECULATE_WAIT if still being written), or None."""
+    if speculator is None:
+        return None
+    branch = speculator.take(key, len(h), player_text)
+    if branch is None:
+        return None
+    text = branch.result(SPECULATE_WAIT)
+    if not branch.done:
+        print("Speculative branch is taking too long; generating the turn directly")
+        branch.cancel()
+    return text
+
+
+def _finish_turn(h, player_text, ai_response, chapter_index):
+    """
+    Persist the player's message and the assistant reply (only the new messages), start the
+    scene image and return the turn payload for the client. Raises StaleHistory if another
+    server process stored a turn for this game since h was loaded.
+    """
+    new_messages = [{'role': 'user', 'content': player_text}, {'role': 'assistant', 'content': ai_response}]
+    history_store.append(session["_history_key"], new_messages, expected_length=len(h))
+    h.extend(new_messages)
+
+    parsed = parse_scene(ai_response)
+    if parsed.warnings:
+        print(f"Scene format warnings: {', '.join(parsed.warnings)}")
+    scene_text = parsed.scene_text
+    options = dict(parsed.options)
     scene_id = f"scene_{len(h)}"
 
-    thread = threading.Thread(target=generate_image_async, args=(scene_text, scene_id))
-    thread.daemon = True
-    thread.start()
+    start_scene_image(scene_text, session["_history_key"], scene_id)
+    _speculate_turn(session["_history_key"], h, options)
 
-    return jsonify({
+    return {
         "scene": scene_text,
         "options": options,
-        "player_status": session.get('player_status', ''),
-        "scene_id": scene_id
-    })
+        "player_status": _chapter_status(chapter_index, ai_response),
+        "scene_id": scene_id,
+        "turn": len(h),
+    }
+
+
+@app.route("/make_choice", methods=["POST"])
+def make_choice():
+    data = request.get_json()
+
+    key = _history_key()
+    if not session_locks.acquire(key, blocking=False):
+        return _turn_busy_response()
+    try:
+        h, player_text, error = _load_turn(data)
+        if error is not None:
+            return error
+
+        try:
+            ai_response = _speculated_reply(key, h, player_text)
+            if not ai_response:
+                with admission.slot(TURN):
+                    ai_response = generate_response(_turn_messages(h, player_text))
+        except LLMQueueFull as e:
+            return _llm_busy_response(e)
+        except ConnectionError:
+            return _ollama_down_response()
+
+        nxt = session.get("story_chapter_index", 1) + 1
+        try:
+            payload = _finish_turn(h, player_text, ai_response, nxt)
+        except StaleHistory:
+            return _stale_turn_response()
+    finally:
+        session_locks.release(key)
+    session["story_chapter_index"] = nxt
+    session["player_status"] = payload["player_status"]
+    session.modified = True
+    return jsonify(payload)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route("/make_choice_stream", methods=["POST"])
+def make_choice_stream():
+    """
+    Streaming variant of /make_choice (Server-Sent Events over a POST response).
+    Emits 'token' events with displayable scene text as Ollama generates it, then one 'done'
+    event with the same payload /make_choice returns once history has been updated.
+    """
+    data = request.get_json()
+
+    key = _history_key()
+    if not session_locks.acquire(key, blocking=False):
+        return _turn_busy_response()
+    # The lock (and the model slot) is held until the stream ends or the client goes away, whichever path
+    # gets there first; an error before the response is returned releases it at once.
+    released = []
+    slots = []
+
+    def release():
+        if not released:
+            released.append(True)
+            for ticket in slots:
+                admission.release(ticket)
+            session_locks.release(key)
+
+    try:
+        h, player_text, error = _load_turn(data)
+        if error is not None:
+            release()
+            return error
+
+        reply = _speculated_reply(key, h, player_text)
+        if not reply:
+            try:
+                slots.append(admission.acquire(TURN))
+            except LLMQueueFull as e:
+                release()
+                return _llm_busy_response(e)
+        tokens = iter([reply]) if reply else generate_response_stream(_turn_messages(h, player_text))
+        # Pull the first chunk now so an unreachable Ollama is still a plain 503, not a broken stream.
+        try:
+            first = next(tokens, "")
+        except ConnectionError:
+            release()
+            return _ollama_down_response()
+
+        # Headers (and the session cookie) go out with the first byte, so the session is updated up front;
+        # the chapter title part of player_status is recomputed from history on the next page render.
+        nxt = session.get("story_chapter_index", 1) + 1
+        session["story_chapter_index"] = nxt
+        session["player_status"] = f"Story: Chapter {nxt}"
+        session.modified = True
+
+        def events():
+            try:
+                parts = [first]
+                scene_filter = SceneStreamFilter()
+                text = scene_filter.feed(first)
+                if text:
+                    yield _sse("token", {"text": text})
+                try:
+                    for delta in tokens:
+                        parts.append(delta)
+                        text = scene_filter.feed(delta)
+                        if text:
+                            yield _sse("token", {"text": text})
+                except Exception as e:
+                    print(f"Error streaming story turn: {e}")
+                    yield _sse("error", {"error": "ollama", "message": "The story was interrupted. Please try again."})
+                    return
+                text = scene_filter.flush()
+                if text:
+                    yield _sse("token", {"text": text})
+                try:
+                    payload = _finish_turn(h, player_text, "".join(parts), nxt)
+                except StaleHistory:
+                    yield _sse("error", {"error": "stale_turn", "message": STALE_TURN_MESSAGE})
+                    return
+            finally:
+                release()
+            yield _sse("done", payload)
+
+        response = Response(
+            stream_with_context(events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        response.call_on_close(release)
+    except BaseException:
+        release()
+        raise
+    return response
+
+def _image_status(found, job):
+    """/get_image payload for an image_results lookup."""
+    if not found:
+        # Evicted, expired, lost in a restart or stored by another server process: nothing to wait
+        # for, so the page shows the options without an image instead of polling forever
+        return {"image_url": None, "ready": True, "status": "unknown"}
+    if job is None:
+        # Queue was full when the scene was created: no image for this scene
+        return {"image_url": None, "ready": True, "status": REJECTED}
+    return {
+        "image_url": job.image_url,
+        "image_srcset": scene_image_srcset_for(job.image_url),
+        "ready": job.finished,
+        "status": job.status,
+    }
+
 
 @app.route("/get_image/<scene_id>", methods=["GET"])
 def get_image(scene_id):
-    if scene_id in pending_images:
-        return jsonify({"image_url": pending_images[scene_id], "ready": True})
+    """Polling fallback for /image_events."""
+    image_status_counts["polls"] += 1
+    return jsonify(_image_status(*image_results.get(session.get("_history_key"), scene_id)))
+
+
+# Push channel for image readiness (/image_events): each waiting page holds one open request for
+# the length of a generation, so turn it off (FABLES_IMAGE_PUSH=0) on a small fixed thread pool.
+IMAGE_PUSH = os.environ.get("FABLES_IMAGE_PUSH", "1") == "1"
+IMAGE_EVENT_MAX_WAIT = 300  # seconds before the stream gives up and the page falls back to polling
+IMAGE_EVENT_KEEPALIVE = 15  # seconds between SSE comments that keep proxies from closing the stream
+image_status_counts = {"polls": 0, "push_streams": 0}
+
+
+@app.route("/image_events/<scene_id>", methods=["GET"])
+def image_events(scene_id):
+    """
+    Server-Sent Events push of a scene's image status: one 'image' event with the /get_image
+    payload once the image job has finished, instead of the page polling /get_image.
+    """
+    found, job = image_results.get(session.get("_history_key"), scene_id)
+    image_status_counts["push_streams"] += 1
+    finished = threading.Event()
+    if found and job is not None:
+        image_jobs.add_done_callback(job, lambda _job: finished.set())
+    else:
+        finished.set()
+
+    def events():
+        deadline = time.monotonic() + IMAGE_EVENT_MAX_WAIT
+        while not finished.wait(IMAGE_EVENT_KEEPALIVE) and time.monotonic() < deadline:
+            yield ": keepalive\n\n"
+        yield _sse("image", _image_status(found, job))
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Variant formats in order of preference when the browser's Accept header lists them
+SCENE_IMAGE_FORMATS = (("avif", "image/avif"), ("webp", "image/webp"))
+_PROMPT_HASH_SUFFIX = re.compile(r"_([0-9a-f]{8})\.png$")
+
+
+def scene_image_srcset_for(image_url):
+    """srcset of /scene_image size variants for a /static/images/<name>.png URL ('' if none)."""
+    if not image_url:
+        return ""
+    name = os.path.basename(image_url)
+    return ", ".join(
+        f"{url_for('scene_image', name=name, size=size)} {width}w" for size, width in IMAGE_VARIANT_WIDTHS.items()
+    )
+
+
+@app.route("/scene_image/<name>", methods=["GET"])
+def scene_image(name):
+    """
+    Size- and format-negotiated scene image: ?size=thumb|mobile|full, AVIF/WebP chosen from
+    the Accept header. Variants are immutable (their name carries the prompt hash), so they
+    get a one-year cache lifetime and an ETag of prompt hash + size + format.
+    """
+    size = request.args.get("size", "full")
+    if size not in IMAGE_VARIANT_WIDTHS or name != os.path.basename(name) or not name.endswith(".png"):
+        abort(404)
+    source = os.path.join(TARGET_DIR, name)
+    if not os.path.isfile(source):
+        abort(404)
+    match = _PROMPT_HASH_SUFFIX.search(name)
+    prompt_key = match.group(1) if match else image_png_filename(name)[-12:-4]
+    accepted = {value for value, quality in request.accept_mimetypes if quality > 0}
+
+    for fmt, mimetype in SCENE_IMAGE_FORMATS:
+        path = variant_path(VARIANT_DIR, name, size, fmt)
+        if mimetype in accepted and os.path.isfile(path):
+            response = send_file(path, mimetype=mimetype, etag=f"{prompt_key}-{size}-{fmt}", max_age=31536000)
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            break
     else:
-        return jsonify({"image_url": None, "ready": False})
+        # Variant not built (yet): serve the original briefly and build the variants for next time
+        if IMAGE_VARIANTS:
+            _build_variants(source)
+        response = send_file(source, mimetype="image/png", etag=f"{prompt_key}-png", max_age=60)
+    response.vary.add("Accept")
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Operational counters for the server's caches and queues (JSON)."""
+    return jsonify(
+        {
+            "image_results": image_results.stats(),
+            "image_jobs": image_jobs.stats(),
+            "comfyui": comfyui_health.stats(),
+            "histories": history_store.stats(),
+            "context": context_window.stats(),
+            "ollama": ollama_timings.stats(),
+            "llm_backends": llm.stats(),
+            "admission": admission.stats(),
+            "llm_cache": llm_cache.stats() if llm_cache else None,
+            "scene_parser": parse_cache_stats(),
+            "scene_format": scene_format_stats.stats(),
+            "session_locks": session_locks.stats(),
+            "image_status_requests": dict(image_status_counts),
+            "speculation": speculator.stats() if speculator is not None else {"enabled": False},
+            "image_similarity": image_index.stats() if image_index is not None else {"enabled": False},
+            "opening_pool": opening_pool.stats() if opening_pool is not None else {"enabled": False},
+        }
+    )
 
 
 @app.route("/export_session", methods=["GET"])
@@ -0,0 +1,492 @@
+"""
+ASGI serving mode for the game server:  uvicorn asgi_app:app --port 5000
+
+The routes that wait on the storyteller (/, /make_choice, /make_choice_stream) run as
+coroutines on one event loop and call Ollama through llm.achat (async HTTP clients), so a
+player waiting for a scene costs a suspended coroutine instead of a server thread, as does a
+page waiting on /image_events for its scene image. Their history store calls (which may wait
+on a SQLite lock) run in worker threads (_blocking), never on the loop; /get_image only reads
+memory and runs inline. Every other route (static files, /scene_image, /export_session, which
+writes a file, /metrics, /restart) is the Flask app behind a small WSGI thread pool.
+
+Handlers run inside a Flask request context built from the ASGI scope, so sessions (the same
+signed cookie), the history store, per-session locks and image jobs are shared with app.py.
+"""
+import asyncio
+import io
+import sys
+import time
+
+from a2wsgi import WSGIMiddleware
+from flask import copy_current_request_context, render_template, request, session
+from werkzeug.exceptions import HTTPException
+
+from admission import LLMQueueFull, OPENING, TURN
+from game.engine import SceneJSONParser
+from history_store import StaleHistory
+from app import (
+    IMAGE_EVENT_KEEPALIVE,
+    IMAGE_EVENT_MAX_WAIT,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_MODEL,
+    OLLAMA_OPTIONS,
+    SPECULATE_WAIT,
+    STALE_TURN_MESSAGE,
+    SceneStreamFilter,
+    _begin_game,
+    _cache_key,
+    _finish_turn,
+    _history_key,
+    _image_status,
+    _llm_busy_page,
+    _llm_busy_response,
+    _load_turn,
+    _new_game_setup,
+    _ollama_down_response,
+    _opening_messages,
+    _pooled_opening,
+    _release_server_history,
+    _sse,
+    _stale_turn_response,
+    _story_mode,
+    _story_reply,
+    _story_request,
+    _story_rest,
+    _turn_busy_response,
+    _turn_messages,
+    admission,
+    app as flask_app,
+    get_image,
+    image_jobs,
+    image_results,
+    image_status_counts,
+    index,
+    llm,
+    llm_cache,
+    ollama_timings,
+    opening_pool,
+    session_locks,
+    speculator,
+)
+
+# Threads for the routes served by the Flask app itself (file serving, metrics)
+WSGI_WORKERS = 10
+
+_wsgi = WSGIMiddleware(flask_app, workers=WSGI_WORKERS)
+
+
+async def generate_response_async(history):
+    """Async counterpart of app.generate_response."""
+    mode = _story_mode(True)
+    messages, output_format = _story_request(history, mode)
+    key = _cache_key(messages)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        return cached
+    started = time.monotonic()
+    response = await llm.achat(
+        model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE,
+        format=output_format,
+    )
+    ollama_timings.record(response, messages)
+    text = _story_reply(mode, response['message']['content'])
+    if key:
+        llm_cache.put(key, text, time.monotonic() - started)
+    return text
+
+
+async def generate_response_stream_async(history):
+    """Async counterpart of app.generate_response_stream."""
+    mode = _story_mode(True)
+    messages, output_format = _story_request(history, mode)
+    key = _cache_key(messages)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        yield cached
+        return
+    parser = SceneJSONParser() if mode == "json" else None
+    started = time.monotonic()
+    parts = []
+    shown = []
+    async for chunk in await llm.achat(
+        model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE,
+        format=output_format, stream=True,
+    ):
+        delta = chunk['message']['content']
+        if delta:
+            parts.append(delta)
+            if parser is None:
+                yield delta
+            else:
+                scene = parser.feed(delta)
+                if scene:
+                    shown.append(scene)
+                    yield scene
+        if chunk.get('done'):
+            ollama_timings.record(chunk, messages)
+            text = _story_reply(mode, "".join(parts), parser)
+            if parser is not None:
+                yield _story_rest(text, "".join(shown))
+            if key:
+                llm_cache.put(key, text, time.monotonic() - started)
+
+
+async def _blocking(fn, *args):
+    """fn(*args) in a worker thread, inside the current request context (same session object)."""
+    return await asyncio.to_thread(copy_current_request_context(fn), *args)
+
+
+async def _admitted_response_async(priority, history):
+    """generate_response_async holding a model slot (app.admission) for the call."""
+    ticket = await admission.acquire_async(priority)
+    try:
+        return await generate_response_async(history)
+    finally:
+        admission.release(ticket)
+
+
+async def _speculated_reply_async(key, h, player_text):
+    """Async counterpart of app._speculated_reply: awaits a branch still being written (up to SPECULATE_WAIT)."""
+    if speculator is None:
+        return None
+    branch = speculator.take(key, len(h), player_text)
+    if branch is None:
+        return None
+    if not branch.done:
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def resolve():
+            if not finished.done():
+                finished.set_result(None)
+
+        branch.add_done_callback(lambda _branch: loop.call_soon_threadsafe(resolve))
+        try:
+            await asyncio.wait_for(finished, SPECULATE_WAIT)
+        except asyncio.TimeoutError:
+            print("Speculative branch is taking too long; generating the turn directly")
+            branch.cancel()
+            return None
+    return branch.text
+
+
+async def _replay(text):
+    yield text
+
+
+# === ASGI <-> Flask glue ===
+def _wsgi_environ(scope, body):
+    """WSGI environ for a Flask request context from an ASGI http scope and its body."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return bytes(body)
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _finish(rv):
+    """Flask response for a view return value, with after-request processing (session cookie)."""
+    return flask_app.process_response(flask_app.make_response(rv))
+
+
+async def _send_headers(send, response):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.to_wsgi_list()],
+    })
+
+
+async def _send_response(send, rv):
+    response = _finish(rv)
+    await _send_headers(send, response)
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+# === Routes ===
+async def index_route(scope, receive, send):
+    await _read_body(receive)
+    with flask_app.request_context(_wsgi_environ(scope, b"")):
+        setup = _new_game_setup()
+        if setup is not None:
+            # Same flow as app.index, with the opening scene awaited instead of blocking a thread
+            await _blocking(_release_server_history)
+            session.clear()
+            h = _opening_messages(*setup)
+            try:
+                ai_intro_response = _pooled_opening(*setup) or await _admitted_response_async(OPENING, h)
+            except LLMQueueFull as e:
+                await _send_response(send, _llm_busy_page(e))
+                return
+            except ConnectionError:
+                await _send_response(send, render_template("ollama_error.html"))
+                return
+            await _blocking(_begin_game, h, ai_intro_response, *setup)
+        await _send_response(send, await _blocking(index))
+
+
+async def make_choice_route(scope, receive, send):
+    body = await _read_body(receive)
+    with flask_app.request_context(_wsgi_environ(scope, body)):
+        try:
+            data = request.get_json()
+        except HTTPException as e:
+            # Malformed JSON body: the same 400 the Flask app answers with
+            await _send_response(send, flask_app.handle_user_exception(e))
+            return
+        key = _history_key()
+        if not session_locks.acquire(key, blocking=False):
+            await _send_response(send, _turn_busy_response())
+            return
+        try:
+            h, player_text, rv = await _blocking(_load_turn, data)
+            if rv is None:
+                try:
+                    ai_response = await _speculated_reply_async(key, h, player_text)
+                    ai_response = ai_response or await _admitted_response_async(TURN, _turn_messages(h, player_text))
+                except LLMQueueFull as e:
+                    rv = _llm_busy_response(e)
+                except ConnectionError:
+                    rv = _ollama_down_response()
+                else:
+                    nxt = session.get("story_chapter_index", 1) + 1
+                    try:
+                        rv = await _blocking(_finish_turn, h, player_text, ai_response, nxt)
+                    except StaleHistory:
+                        rv = _stale_turn_response()
+                    else:
+                        session["story_chapter_index"] = nxt
+                        session["player_status"] = rv["player_status"]
+                        session.modified = True
+        finally:
+            session_locks.release(key)
+        await _send_response(send, rv)
+
+
+async def _stream_turn(send, data, release, slots):
+    """
+    Body of /make_choice_stream: same events as app.make_choice_stream (release: frees the turn lock
+    and the model slot, which is added to slots).
+    """
+    h, player_text, error = await _blocking(_load_turn, data)
+    if error is not None:
+        await _send_response(send, error)
+        return
+    reply = await _speculated_reply_async(session["_history_key"], h, player_text)
+    if not reply:
+        try:
+            slots.append(await admission.acquire_async(TURN))
+        except LLMQueueFull as e:
+            await _send_response(send, _llm_busy_response(e))
+            return
+    tokens = _replay(reply) if reply else generate_response_stream_async(_turn_messages(h, player_text))
+    try:
+        first = await anext(tokens, "")
+    except ConnectionError:
+        await _send_response(send, _ollama_down_response())
+        return
+
+    nxt = session.get("story_chapter_index", 1) + 1
+    session["story_chapter_index"] = nxt
+    session["player_status"] = f"Story: Chapter {nxt}"
+    session.modified = True
+    response = _finish(flask_app.response_class(
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    ))
+    await _send_headers(send, response)
+
+    async def emit(event, payload):
+        await send({"type": "http.response.body", "body": _sse(event, payload).encode("utf-8"), "more_body": True})
+
+    parts = [first]
+    scene_filter = SceneStreamFilter()
+    text = scene_filter.feed(first)
+    if text:
+        await emit("token", {"text": text})
+    try:
+        async for delta in tokens:
+            parts.append(delta)
+            text = scene_filter.feed(delta)
+            if text:
+                await emit("token", {"text": text})
+    except Exception as e:
+        print(f"Error streaming story turn: {e}")
+        await emit("error", {"error": "ollama", "message": "The story was interrupted. Please try again."})
+    else:
+        text = scene_filter.flush()
+        if text:
+            await emit("token", {"text": text})
+        try:
+            payload = await _blocking(_finish_turn, h, player_text, "".join(parts), nxt)
+        except StaleHistory:
+            await emit("error", {"error": "stale_turn", "message": STALE_TURN_MESSAGE})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        # Unlock before 'done' so the player's next choice is never refused as in progress
+        release()
+        await emit("done", payload)
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def make_choice_stream_route(scope, receive, send):
+    body = await _read_body(receive)
+    with flask_app.request_context(_wsgi_environ(scope, body)):
+        try:
+            data = request.get_json()
+        except HTTPException as e:
+            # Malformed JSON body: the same 400 the Flask app answers with
+            await _send_response(send, flask_app.handle_user_exception(e))
+            return
+        key = _history_key()
+        if not session_locks.acquire(key, blocking=False):
+            await _send_response(send, _turn_busy_response())
+            return
+        released = []
+        slots = []
+
+        def release():
+            if not released:
+                released.append(True)
+                for ticket in slots:
+                    admission.release(ticket)
+                session_locks.release(key)
+
+        try:
+            # A player who closes the page cancels the turn, which also closes the Ollama stream.
+            turn = asyncio.ensure_future(_stream_turn(send, data, release, slots))
+            disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+            await asyncio.wait({turn, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            disconnect.cancel()
+            if not turn.done():
+                turn.cancel()
+                await asyncio.wait({turn})
+            if not turn.cancelled():
+                turn.result()  # re-raises an error from the turn (logged by the server, 500 if nothing was sent)
+        finally:
+            release()
+
+
+async def image_events_route(scope, receive, send, scene_id):
+    """Same events as app.image_events; the wait is a future resolved from the image worker thread."""
+    await _read_body(receive)
+    with flask_app.request_context(_wsgi_environ(scope, b"")):
+        found, job = image_results.get(session.get("_history_key"), scene_id)
+        image_status_counts["push_streams"] += 1
+        response = _finish(flask_app.response_class(
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        ))
+        await _send_headers(send, response)
+        if found and job is not None:
+            loop = asyncio.get_running_loop()
+            finished = loop.create_future()
+
+            def resolve():
+                if not finished.done():
+                    finished.set_result(None)
+
+            image_jobs.add_done_callback(job, lambda _job: loop.call_soon_threadsafe(resolve))
+            disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+            deadline = loop.time() + IMAGE_EVENT_MAX_WAIT
+            try:
+                while not finished.done() and loop.time() < deadline:
+                    await asyncio.wait(
+                        {finished, disconnect}, timeout=IMAGE_EVENT_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if disconnect.done():
+                        return
+                    if not finished.done():
+                        await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+            finally:
+                disconnect.cancel()
+        await send({"type": "http.response.body", "body": _sse("image", _image_status(found, job)).encode("utf-8")})
+
+
+def _inline(view):
+    """Route for a Flask view that never blocks on the network: run it on the event loop."""
+    async def route(scope, receive, send, *args):
+        body = await _read_body(receive)
+        with flask_app.request_context(_wsgi_environ(scope, body)):
+            await _send_response(send, view(*args))
+    return route
+
+
+ROUTES = {
+    ("GET", "/"): index_route,
+    ("POST", "/make_choice"): make_choice_route,
+    ("POST", "/make_choice_stream"): make_choice_stream_route,
+}
+# Routes with one path parameter: prefix -> handler(scope, receive, send, param)
+PARAM_ROUTES = {
+    "/get_image/": _inline(get_image),
+    "/image_events/": image_events_route,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if opening_pool is not None:
+                opening_pool.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    path = scope["path"]
+    route = ROUTES.get((scope["method"], path))
+    if route is not None:
+        await route(scope, receive, send)
+        return
+    if scope["method"] == "GET":
+        for prefix, handler in PARAM_ROUTES.items():
+            param = path[len(prefix):]
+            if path.startswith(prefix) and param and "/" not in param:
+                await handler(scope, receive, send, param)
+                return
+    await _wsgi(scope, receive, send)
@@ -2,7 +2,21 @@ import json
 import time
 import random
 import os
-from generate_images import generate_image_from_text, check_comfyui_status
+from collections import deque
+from run_journal import RunJournal
+from generate_images import (
+    TARGET_DIR,
+    build_generation_prompt,
+    cancel_prompt,
+    check_comfyui_status,
+    download_output_image,
+    fetch_history,
+    generate_image_from_text,
+    history_output_images,
+    queue_prompt,
+    sanitize_filename,
+    variant_filename,
+)
 
 # 250 MMO RPG scenarios organized by typical MMO zones and activities
 MMO_RPG_SCENARIOS = [
@@ -243,6 +257,29 @@ MMO_RPG_SCENARIOS = [
     "time capsule ceremony with historical significance and nostalgia"
 ]
 
+# Append-only per-scenario run state; reruns skip completed scenarios and retry failures
+MMO_JOURNAL_PATH = "static/images/mmo_generation_journal.jsonl"
+# Consecutive refused queue_prompt calls (ComfyUI down) before a pipelined run stops; they back off
+# 2, 4, 8, ... seconds (at most 60) and do not count as attempts at the scenario
+MAX_QUEUE_FAILURES = 6
+
+
+def _resume_from_journal(journal, scenarios):
+    """Split scenarios into (already done as (scenario, url) pairs, still to run, out of retries)."""
+    done, todo, exhausted = [], [], []
+    for scenario in scenarios:
+        if journal.is_done(scenario):
+            done.append((scenario, journal.output(scenario)))
+        elif journal.should_run(scenario):
+            todo.append(scenario)
+        else:
+            exhausted.append(scenario)
+    if done or exhausted:
+        print(f"Resuming from {journal.path}: {len(done)} done, {len(todo)} to run, "
+              f"{len(exhausted)} out of retries ({journal.max_retries})")
+    return done, todo, exhausted
+
+
 def enhance_mmo_prompt(scenario):
     """Enhance scenario with MMO-specific visual elements"""
     base_style = "fantasy MMO concept art, vibrant colors, atmospheric lighting, detailed digital painting, cinematic composition"
@@ -271,7 +308,8 @@ def enhance_mmo_prompt(scenario):
     
     return f"{scenario}, {base_style}, {mmo_elements}, professional MMORPG game art"
 
-def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batches=45):
+def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batches=45,
+                              journal_path=MMO_JOURNAL_PATH, max_retries=3):
     """
     Generate MMO-style images with enhanced prompts and conservative GPU usage
     
@@ -279,10 +317,19 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
         scenarios: List of scenario descriptions. If None, uses MMO_RPG_SCENARIOS
         batch_size: Number of images to generate before taking a break
         delay_between_batches: Seconds to wait between batches (reduced for faster generation)
+        journal_path: Run journal; scenarios already done there are skipped on rerun
+        max_retries: Attempts per scenario (across runs) before it is left as failed
     """
     if scenarios is None:
         scenarios = MMO_RPG_SCENARIOS
     
+    journal = RunJournal(journal_path, max_retries=max_retries)
+    successful_generations, scenarios, failed_generations = _resume_from_journal(journal, scenarios)
+    if not scenarios:
+        print("✅ Nothing left to generate.")
+        save_mmo_generation_manifest(successful_generations, failed_generations)
+        return
+    
     print(f"🎮 Starting MMO batch generation of {len(scenarios)} images")
     print(f"Batch size: {batch_size}, Delay between batches: {delay_between_batches}s")
     
@@ -291,8 +338,6 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
         print("❌ ComfyUI is not running! Please start ComfyUI first.")
         return
     
-    successful_generations = []
-    failed_generations = []
     
     total_batches = (len(scenarios) + batch_size - 1) // batch_size
     
@@ -310,12 +355,15 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
             try:
                 # Enhance the scenario with MMO-specific elements
                 enhanced_prompt = enhance_mmo_prompt(scenario)
-                result = generate_image_from_text(enhanced_prompt)
+                journal.mark_queued(scenario)
+                result = generate_image_from_text(enhanced_prompt, workflow="mmo", profile="batch")
                 
                 if result:
+                    journal.mark_done(scenario, result, os.path.join(TARGET_DIR, os.path.basename(result)))
                     successful_generations.append((scenario, result))
                     print(f"✅ Success: {result}")
                 else:
+                    journal.mark_failed(scenario)
                     failed_generations.append(scenario)
                     print(f"❌ Failed to generate image")
                 
@@ -328,6 +376,7 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
                 return
             except Exception as e:
                 print(f"❌ Error generating image for scenario {i}: {e}")
+                journal.mark_failed(scenario, str(e))
                 failed_generations.append(scenario)
         
         # Take a break between batches (except for the last batch)
@@ -344,7 +393,8 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
     print(f"{'='*70}")
     print(f"✅ Successful generations: {len(successful_generations)}")
     print(f"❌ Failed generations: {len(failed_generations)}")
-    print(f"📊 Success rate: {len(successful_generations)/len(scenarios)*100:.1f}%")
+    total = len(successful_generations) + len(failed_generations)
+    print(f"📊 Success rate: {len(successful_generations)/total*100:.1f}%")
     
     if failed_generations:
         print(f"\n⚠️ Failed scenarios:")
@@ -354,6 +404,207 @@ def generate_mmo_batch_images(scenarios=None, batch_size=10, delay_between_batch
     # Save a manifest of all generated images
     save_mmo_generation_manifest(successful_generations, failed_generations)
 
+class ThroughputPacer:
+    """
+    Thermal pacing from measured throughput instead of fixed sleeps.
+
+    Tracks (time, images) per finished prompt over a sliding window; when the recent
+    images/second rate drops below (1 - tolerance) of the best rate seen so far (the GPU is
+    throttling), it asks for a cool-down pause. The caller lets the GPU go idle for it (no
+    prompts queued) and calls restart() afterwards to start measuring afresh. Windows shorter
+    than min_span seconds are too noisy to judge and are ignored.
+    """
+
+    def __init__(self, window=10, tolerance=0.35, cooldown=30, min_span=20.0):
+        self.window = window
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.min_span = min_span
+        self._completions = deque(maxlen=window)
+        self.best_rate = 0.0
+        self.pauses = 0
+
+    def record(self, images=1):
+        self._completions.append((time.time(), images))
+
+    def _span(self):
+        return self._completions[-1][0] - self._completions[0][0] if self._completions else 0.0
+
+    def rate(self):
+        span = self._span()
+        if len(self._completions) < 2 or span <= 0:
+            return 0.0
+        # Images finished after the first timestamp, per second
+        return sum(images for _, images in list(self._completions)[1:]) / span
+
+    def cooldown_needed(self):
+        """Seconds to pause now (0 when throughput is healthy)."""
+        if len(self._completions) < self.window or self._span() < self.min_span:
+            return 0
+        current = self.rate()
+        if current > self.best_rate:
+            self.best_rate = current
+            return 0
+        if current < self.best_rate * (1 - self.tolerance):
+            self.pauses += 1
+            return self.cooldown
+        return 0
+
+    def restart(self):
+        """Forget the current window (after a cool-down, so the pause itself is not measured)."""
+        self._completions.clear()
+
+
+def generate_mmo_pipelined(scenarios=None, in_flight=4, images_per_prompt=1, max_wait_time=900,
+                           throttle_tolerance=0.35, cooldown=30, journal_path=MMO_JOURNAL_PATH, max_retries=3):
+    """
+    Pipelined MMO batch: keep `in_flight` prompts queued in ComfyUI so the GPU never idles
+    between images, and pace on measured throughput instead of fixed per-image/batch sleeps.
+
+    Args:
+        scenarios: List of scenario descriptions. If None, uses MMO_RPG_SCENARIOS
+        in_flight: Prompts kept queued in ComfyUI at once
+        images_per_prompt: batch_size of the EmptyLatentImage node; extra images of the same
+            prompt are saved as <name>_v2.png, <name>_v3.png, ...
+        max_wait_time: Seconds before an in-flight prompt is counted as failed (and removed from ComfyUI)
+        throttle_tolerance: Fractional throughput drop (vs best seen) that triggers a cool-down
+        cooldown: Seconds to pause when throughput drops, once the prompts in flight have finished
+        journal_path: Run journal; scenarios already done there are skipped on rerun
+        max_retries: Attempts per scenario (across runs) before it is left as failed
+    """
+    if scenarios is None:
+        scenarios = MMO_RPG_SCENARIOS
+
+    journal = RunJournal(journal_path, max_retries=max_retries)
+    successful_generations, todo, failed_generations = _resume_from_journal(journal, scenarios)
+    pending = deque()
+    on_disk = 0
+    for scenario in todo:
+        image_filename = sanitize_filename(enhance_mmo_prompt(scenario))
+        local_path = os.path.join(TARGET_DIR, image_filename)
+        if os.path.exists(local_path):
+            journal.mark_done(scenario, f"/static/images/{image_filename}", local_path)
+            successful_generations.append((scenario, f"/static/images/{image_filename}"))
+            on_disk += 1
+        else:
+            pending.append(scenario)
+    if on_disk:
+        print(f"Skipping {on_disk} scenarios already on disk")
+    if not pending:
+        print("✅ Nothing left to generate.")
+        save_mmo_generation_manifest(successful_generations, failed_generations)
+        return
+
+    print(f"🎮 Starting pipelined MMO generation of {len(pending)} prompts")
+    print(f"In flight: {in_flight}, images per prompt: {images_per_prompt}")
+
+    if not check_comfyui_status():
+        print("❌ ComfyUI is not running! Please start ComfyUI first.")
+        return
+
+    pacer = ThroughputPacer(tolerance=throttle_tolerance, cooldown=cooldown)
+    active = {}  # prompt_id -> (scenario, image_filename, submitted_at)
+    started = time.time()
+    poll_interval = 0.25
+    cooldown_pending = 0  # seconds of cool-down owed; no new prompts are queued until it is taken
+    queue_failures = 0  # consecutive queue_prompt failures
+    retry_queue_at = 0.0
+
+    try:
+        while pending or active:
+            # Top up ComfyUI's queue
+            while pending and len(active) < in_flight and not cooldown_pending and time.time() >= retry_queue_at:
+                scenario = pending.popleft()
+                enhanced_prompt = enhance_mmo_prompt(scenario)
+                prompt = build_generation_prompt(
+                    enhanced_prompt, workflow="mmo", profile="batch", batch_size=images_per_prompt
+                )
+                result = queue_prompt(prompt)
+                if result and "prompt_id" in result:
+                    queue_failures = 0
+                    journal.mark_queued(scenario)
+                    active[result["prompt_id"]] = (scenario, sanitize_filename(enhanced_prompt), time.time())
+                else:
+                    # ComfyUI refused the prompt or is down: not the scenario's fault, so put it back
+                    pending.appendleft(scenario)
+                    queue_failures += 1
+                    wait = min(2 ** queue_failures, 60)
+                    retry_queue_at = time.time() + wait
+                    if queue_failures < MAX_QUEUE_FAILURES or active:
+                        print(f"⚠️ Could not queue a prompt ({queue_failures} in a row); retrying in {wait}s")
+                    break
+            if queue_failures >= MAX_QUEUE_FAILURES and not active:
+                print(f"❌ ComfyUI is not accepting prompts; stopping with {len(pending)} left. "
+                      "Rerun to continue from the journal.")
+                break
+
+            finished_any = False
+            for prompt_id, (scenario, image_filename, submitted_at) in list(active.items()):
+                try:
+                    entry = fetch_history(prompt_id)
+                except Exception:
+                    entry = None
+                if entry is None:
+                    if time.time() - submitted_at > max_wait_time:
+                        del active[prompt_id]
+                        cancel_prompt(prompt_id)  # or it keeps the GPU busy after we gave up on it
+                        journal.mark_failed(scenario, "timed out")
+                        failed_generations.append(scenario)
+                        print(f"❌ Timed out: {scenario[:80]}")
+                    continue
+
+                del active[prompt_id]
+                finished_any = True
+                saved = [
+                    variant_filename(image_filename, index)
+                    for index, image in enumerate(history_output_images(entry))
+                    if download_output_image(image, variant_filename(image_filename, index))
+                ]
+                if saved:
+                    pacer.record(len(saved))
+                    journal.mark_done(scenario, f"/static/images/{saved[0]}", os.path.join(TARGET_DIR, saved[0]))
+                    successful_generations.append((scenario, f"/static/images/{saved[0]}"))
+                    done = len(successful_generations) + len(failed_generations)
+                    print(f"✅ [{done}/{len(scenarios)}] {saved[0]} ({pacer.rate() * 60:.1f} images/min)")
+                else:
+                    journal.mark_failed(scenario, "no output image")
+                    failed_generations.append(scenario)
+                    print(f"❌ No output for: {scenario[:80]}")
+
+            if not cooldown_pending:
+                cooldown_pending = pacer.cooldown_needed()
+                if cooldown_pending:
+                    print(f"\n⏱️ Throughput dropped below {(1 - throttle_tolerance) * 100:.0f}% of best; "
+                          f"letting {len(active)} queued prompts finish before cooling down")
+            # The GPU only cools once ComfyUI's queue is empty
+            if cooldown_pending and not active:
+                print(f"⏱️ Cooling down {cooldown_pending}s...")
+                time.sleep(cooldown_pending)
+                pacer.restart()
+                cooldown_pending = 0
+            if finished_any:
+                poll_interval = 0.25
+            elif active:
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 1.5, 2.0)
+            elif pending:
+                time.sleep(max(0.0, retry_queue_at - time.time()))
+    except KeyboardInterrupt:
+        print(f"\n⚠️ Generation interrupted by user with {len(active) + len(pending)} prompts unfinished")
+        save_mmo_generation_manifest(successful_generations, failed_generations)
+        return
+
+    elapsed = time.time() - started
+    print(f"\n{'='*70}")
+    print(f"PIPELINED MMO GENERATION COMPLETE in {elapsed / 60:.1f} min")
+    print(f"{'='*70}")
+    print(f"✅ Successful generations: {len(successful_generations)}")
+    print(f"❌ Failed generations: {len(failed_generations)}")
+    print(f"⏱️ Cool-down pauses: {pacer.pauses}")
+    print(f"📒 Journal: {journal.summary()}")
+    save_mmo_generation_manifest(successful_generations, failed_generations)
+
+
 def save_mmo_generation_manifest(successful, failed):
     """Save a JSON manifest of all generated MMO images"""
     manifest = {
@@ -433,8 +684,9 @@ if __name__ == "__main__":
     print("3. Test with 10 sample MMO images")
     print("4. Quick starter zone generation (30 images)")
     print("5. Essential MMO zones only (100 core images)")
+    print("6. Pipelined full collection (keeps several prompts queued in ComfyUI)")
     
-    choice = input("\nEnter your choice (1-5): ").strip()
+    choice = input("\nEnter your choice (1-6): ").strip()
     
     if choice == "1":
         # Generate all MMO images with conservative settings
@@ -481,5 +733,8 @@ if __name__ == "__main__":
         print(f"Generating {len(essential_scenarios)} essential MMO images...")
         generate_mmo_batch_images(essential_scenarios, batch_size=10, delay_between_batches=40)
     
+    elif choice == "6":
+        generate_mmo_pipelined(in_flight=4)
+    
     else:
         print("Invalid choice. Exiting...")
\ No newline at end of file
@@ -1,72 +1,295 @@
+import argparse
+import hashlib
+import json
 import os
-from PIL import Image
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, features
+
+# Resized variants served to browsers: name -> max width in pixels (never upscaled)
+VARIANTS = {"thumb": 320, "mobile": 720, "full": 1280}
+# Pillow encoder settings per output format
+FORMAT_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "avif": {"format": "AVIF", "quality": 60, "speed": 6},
+    "jpg": {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True},
+}
+SOURCE_EXTS = (".png", ".jpg", ".jpeg")
+MANIFEST_NAME = ".variants_manifest.json"
+# Serializes the in-app hook's manifest updates (read, add one entry, rewrite)
+_manifest_lock = threading.Lock()
+
+
+def available_formats():
+    """Output formats this Pillow build can encode (AVIF needs Pillow built with libavif)."""
+    formats = ["webp"] if features.check("webp") else []
+    if features.check("avif"):
+        formats.append("avif")
+    return formats or ["jpg"]
+
+
+def variant_path(output_dir, source_name, variant, fmt):
+    """static/images/foo_1a2b3c4d.png -> <output_dir>/foo_1a2b3c4d.mobile.webp"""
+    stem = os.path.splitext(source_name)[0]
+    return os.path.join(output_dir, f"{stem}.{variant}.{fmt}")
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _to_rgb(img):
+    if img.mode == 'RGBA':
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[3])
+        return rgb_img
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def build_variants(input_path, output_dir, variants=None, formats=None):
+    """
+    Write every (variant size x format) of one image into output_dir, each via a temp file
+    renamed into place. Returns the list of written paths.
+    """
+    variants = variants or VARIANTS
+    formats = formats or available_formats()
+    os.makedirs(output_dir, exist_ok=True)
+    source_name = os.path.basename(input_path)
+    written = []
+    with Image.open(input_path) as src:
+        img = _to_rgb(src)
+        img.load()
+    for variant, max_width in variants.items():
+        if img.width > max_width:
+            resized = img.resize((max_width, int(img.height * max_width / img.width)), Image.Resampling.LANCZOS)
+        else:
+            resized = img
+        for fmt in formats:
+            options = dict(FORMAT_OPTIONS[fmt])
+            dst = variant_path(output_dir, source_name, variant, fmt)
+            tmp = f"{dst}.{os.getpid()}.part"
+            resized.save(tmp, options.pop("format"), **options)
+            os.replace(tmp, dst)
+            written.append(dst)
+    return written
+
+
+def _process_one(job):
+    """Process-pool worker: (input_path, output_dir, variants, formats) -> result dict."""
+    input_path, output_dir, variants, formats = job
+    result = {"name": os.path.basename(input_path), "hash": None, "outputs": [], "error": None}
+    try:
+        result["hash"] = file_hash(input_path)
+        result["outputs"] = build_variants(input_path, output_dir, variants, formats)
+        result["input_bytes"] = os.path.getsize(input_path)
+        result["output_bytes"] = sum(os.path.getsize(p) for p in result["outputs"])
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def _load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp = f"{path}.{os.getpid()}.part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _manifest_entry(input_path, digest, outputs):
+    stat = os.stat(input_path)
+    return {
+        "hash": digest,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "outputs": [os.path.basename(p) for p in outputs],
+    }
+
+
+def _record_variants(input_path, output_dir, outputs):
+    """Add one image to the manifest, so compress_directory() skips it until its content changes."""
+    entry = _manifest_entry(input_path, file_hash(input_path), outputs)
+    with _manifest_lock:
+        manifest = _load_manifest(output_dir)
+        manifest[os.path.basename(input_path)] = entry
+        _save_manifest(output_dir, manifest)
+
+
+def _is_current(entry, input_path, expected_outputs):
+    if not entry or not all(os.path.exists(p) for p in expected_outputs):
+        return False
+    # Cheap check first; only hash when size/mtime changed
+    stat = os.stat(input_path)
+    if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return True
+    return entry.get("hash") == file_hash(input_path)
+
+
+def compress_directory(input_dir, output_dir=None, workers=None, variants=None, formats=None, force=False):
+    """
+    Build variants for every PNG/JPEG in input_dir across a process pool. Files whose
+    content hash is unchanged since the last run (and whose outputs exist) are skipped.
+    Returns (processed, skipped, failed) counts.
+    """
+    output_dir = output_dir or os.path.join(input_dir, "variants")
+    variants = variants or VARIANTS
+    formats = formats or available_formats()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _load_manifest(output_dir)
+
+    jobs = []
+    skipped = 0
+    for filename in sorted(os.listdir(input_dir)):
+        input_path = os.path.join(input_dir, filename)
+        if not filename.lower().endswith(SOURCE_EXTS) or not os.path.isfile(input_path):
+            continue
+        expected = [variant_path(output_dir, filename, v, f) for v in variants for f in formats]
+        if not force and _is_current(manifest.get(filename), input_path, expected):
+            skipped += 1
+            continue
+        jobs.append((input_path, output_dir, variants, formats))
+
+    print(f"{len(jobs)} images to process, {skipped} unchanged; formats: {', '.join(formats)}")
+    processed = failed = 0
+    total_in = total_out = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_one, job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            name = result["name"]
+            if result["error"]:
+                failed += 1
+                print(f"Error compressing {name}: {result['error']}")
+                continue
+            processed += 1
+            manifest[name] = _manifest_entry(os.path.join(input_dir, name), result["hash"], result["outputs"])
+            total_in += result["input_bytes"]
+            total_out += result["output_bytes"]
+            print(f"{name}: {result['input_bytes'] / 1024:.1f} KB -> {len(result['outputs'])} variants "
+                  f"({result['output_bytes'] / 1024:.1f} KB total)")
+    _save_manifest(output_dir, manifest)
+
+    if processed:
+        print(f"\nSources {total_in / 1024 / 1024:.1f} MB -> all variants {total_out / 1024 / 1024:.1f} MB")
+    print(f"Done: {processed} processed, {skipped} skipped, {failed} failed")
+    return processed, skipped, failed
+
+
+def compress_new_image(image_path, output_dir=None):
+    """
+    Post-generation hook: build the variants of one scene image in-process, unless they
+    already exist (cached scenes come through here again), and record them in the manifest.
+    """
+    output_dir = output_dir or os.path.join(os.path.dirname(image_path), "variants")
+    name = os.path.basename(image_path)
+    expected = [variant_path(output_dir, name, v, f) for v in VARIANTS for f in available_formats()]
+    if all(os.path.exists(p) for p in expected):
+        return expected
+    try:
+        outputs = build_variants(image_path, output_dir)
+        _record_variants(image_path, output_dir, outputs)
+        return outputs
+    except Exception as e:
+        print(f"Error building variants for {image_path}: {e}")
+        return []
+
 
 def compress_image(input_path, output_path, max_width=1280, quality=85):
     """Compress image by resizing and converting to JPEG"""
     try:
         img = Image.open(input_path)
-        
+
         # Resize if too large
         if img.width > max_width:
             ratio = max_width / img.width
             new_height = int(img.height * ratio)
             img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-        
+
         # Convert to RGB if needed
-        if img.mode == 'RGBA':
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[3])
-            img = rgb_img
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        
+        img = _to_rgb(img)
+
         # Save as JPEG (much smaller than PNG)
         jpeg_path = output_path.replace('.png', '.jpg')
         img.save(jpeg_path, 'JPEG', quality=quality, optimize=True)
-        
+
         original_size = os.path.getsize(input_path) / 1024
         new_size = os.path.getsize(jpeg_path) / 1024
         reduction = ((original_size - new_size) / original_size) * 100
-        
+
         print(f"{os.path.basename(input_path)}: {original_size:.1f} KB -> {new_size:.1f} KB ({reduction:.1f}% reduction)")
         return jpeg_path
     except Exception as e:
         print(f"Error compressing {input_path}: {e}")
         return None
 
-if __name__ == "__main__":
-    screenshots_dir = "screenshots"
+
+def compress_screenshots(screenshots_dir="screenshots"):
+    """Original report workflow: back up screenshots/*.png and convert them to JPEG in place."""
     if not os.path.exists(screenshots_dir):
         print(f"Directory {screenshots_dir} not found!")
         exit(1)
-    
+
     # Create backup directory
     backup_dir = os.path.join(screenshots_dir, "original")
     if not os.path.exists(backup_dir):
         os.makedirs(backup_dir)
         print("Created backup directory")
-    
+
     # Process all PNG files
     png_files = [f for f in os.listdir(screenshots_dir) if f.lower().endswith('.png') and not f.startswith('original')]
-    
+
     if not png_files:
         print("No PNG files found!")
         exit(1)
-    
+
     print(f"Found {len(png_files)} PNG files. Compressing to JPEG...\n")
-    
+
     for filename in png_files:
         input_path = os.path.join(screenshots_dir, filename)
-        
+
         # Backup original if not already backed up
         backup_path = os.path.join(backup_dir, filename)
         if not os.path.exists(backup_path):
-            import shutil
             shutil.copy2(input_path, backup_path)
-        
+
         # Compress to JPEG
-        jpeg_path = compress_image(input_path, input_path, max_width=1280, quality=85)
-    
+        compress_image(input_path, input_path, max_width=1280, quality=85)
+
     print("\nCompression complete! Images converted to JPEG format.")
     print("Original PNG files backed up in screenshots/original/")
     print("Note: Update LaTeX to use .jpg instead of .png")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build WebP/AVIF size variants of images in a directory.")
+    parser.add_argument("input_dir", nargs="?", default="static/images")
+    parser.add_argument("--out", help="output directory (default: <input_dir>/variants)")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--formats", help=f"comma-separated subset of {', '.join(FORMAT_OPTIONS)}")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the source is unchanged")
+    parser.add_argument("--screenshots", action="store_true",
+                        help="legacy mode: convert screenshots/*.png to JPEG in place (with backup)")
+    args = parser.parse_args()
+
+    if args.screenshots:
+        compress_screenshots()
+    else:
+        formats = [f.strip() for f in args.formats.split(",")] if args.formats else None
+        if formats and not set(formats) <= set(FORMAT_OPTIONS):
+            parser.error(f"--formats must be a subset of {', '.join(FORMAT_OPTIONS)}")
+        compress_directory(args.input_dir, args.out, workers=args.workers, formats=formats, force=args.force)
@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+import httpx
+import ollama
+
+from game.context import estimate_tokens, message_tokens
+from game.engine import parse_scene
+
+# Errors after which a request is retried on the next backend (and the failing one marked down),
+# except error responses for a bad request (_client_error), which every backend would refuse alike
+FAILOVER_ERRORS = (ConnectionError, httpx.TransportError, ollama.ResponseError)
+
+MAX_ERROR_CHARS = 200
+
+FAKE_SCENES = [
+    (
+        "A little fox waves hello from a sunny meadow. Birds sing in the tall green grass, and a soft "
+        "wind carries the smell of flowers. Your friend wags happily beside you.\n\n"
+        "1. Follow the fox to the stream\n2. Pick some flowers\n3. Climb the little hill\n\n"
+        "Chapter: The sunny meadow"
+    ),
+    (
+        "The path bends past a mossy old bridge. Under it a small frog sits on a stone and blinks at you, "
+        "and bright fish swim in the clear water below.\n\n"
+        "1. Say hello to the frog\n2. Cross the bridge\n3. Look for shiny pebbles\n\n"
+        "Chapter: The mossy bridge"
+    ),
+    (
+        "Warm lights glow in the window of a tiny cottage. Someone inside is baking, and the whole garden "
+        "smells of cinnamon. A friendly cat stretches on the doorstep.\n\n"
+        "1. Knock on the door\n2. Pet the cat\n3. Peek into the garden\n\n"
+        "Chapter: The cinnamon cottage"
+    ),
+]
+
+
+class OllamaBackend:
+    """One Ollama server. Sync and async clients keep their HTTP connections open between calls."""
+
+    def __init__(self, host=None, timeout=120.0, connect_timeout=5.0):
+        self.host = host
+        self.name = host or "default"
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._client = ollama.Client(host=host, timeout=self._timeout)
+        self._async_client = None
+
+    def chat(self, **kwargs):
+        return self._client.chat(**kwargs)
+
+    async def achat(self, **kwargs):
+        if self._async_client is None:
+            self._async_client = ollama.AsyncClient(host=self.host, timeout=self._timeout)
+        return await self._async_client.chat(**kwargs)
+
+    def ping(self):
+        self._client.ps()
+
+
+class FakeBackend:
+    """
+    Deterministic stand-in for Ollama (tests, benchmarks, working on the UI without a GPU): the
+    reply is one of FAKE_SCENES picked by a hash of the messages, after delay seconds, streamed
+    one word at a time. Responses have the same fields as Ollama's, timing counts included. With
+    a `format` (structured output) the scene is sent as a {"scene", "options", "chapter"} object.
+    """
+
+    def __init__(self, delay=0.0, name="fake"):
+        self.delay = delay
+        self.name = name
+
+    def _reply(self, messages, output_format=None):
+        digest = hashlib.md5("\n".join(m["content"] for m in messages).encode()).digest()
+        text = FAKE_SCENES[digest[0] % len(FAKE_SCENES)]
+        if not output_format:
+            return text
+        parsed = parse_scene(text)
+        return json.dumps({
+            "scene": parsed.scene_text,
+            "options": [parsed.options[n] for n in sorted(parsed.options)],
+            "chapter": parsed.chapter_title,
+        })
+
+    def _response(self, model, content, messages, output_format=None, done=True):
+        response = {"model": model, "message": {"role": "assistant", "content": content}, "done": done}
+        if done:
+            text = self._reply(messages, output_format)
+            response.update(
+                prompt_eval_count=sum(message_tokens(m) for m in messages),
+                prompt_eval_duration=0,
+                eval_count=estimate_tokens(text),
+                eval_duration=int(self.delay * 1e9),
+                load_duration=0,
+            )
+        return response
+
+    def _chunks(self, model, messages, output_format):
+        words = self._reply(messages, output_format).split(" ")
+        for i, word in enumerate(words):
+            yield self._response(model, word if i == len(words) - 1 else word + " ", messages, done=False)
+        yield self._response(model, "", messages, output_format)
+
+    def chat(self, model="", messages=(), stream=False, format=None, **kwargs):
+        time.sleep(self.delay)
+        if stream:
+            return self._chunks(model, messages, format)
+        return self._response(model, self._reply(messages, format), messages, format)
+
+    async def achat(self, model="", messages=(), stream=False, format=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        if stream:
+            return self._achunks(model, messages, format)
+        return self._response(model, self._reply(messages, format), messages, format)
+
+    async def _achunks(self, model, messages, output_format):
+        for chunk in self._chunks(model, messages, output_format):
+            yield chunk
+
+    def ping(self):
+        pass
+
+
+def _client_error(error):
+    """A 4xx error response (unknown model, bad request): the caller's fault, not the backend's."""
+    return isinstance(error, ollama.ResponseError) and 400 <= error.status_code < 500
+
+
+def _describe(error):
+    return " ".join(str(error).split())[:MAX_ERROR_CHARS] or type(error).__name__
+
+
+class _Member:
+    def __init__(self, backend):
+        self.backend = backend
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+
+class LLMPool:
+    """
+    Spreads chat requests over several backends (Ollama servers or FakeBackend), each call going
+    to the healthy backend with the fewest requests in flight. chat()/achat() take the same
+    arguments as ollama.chat and return the same responses or chunk streams.
+
+    A backend that fails with a connection error, timeout or server error response is marked down
+    and the call is retried on the next one (a stream only until its first chunk: after that the
+    player has seen part of the scene). A background thread pings every backend each
+    health_interval seconds and brings recovered ones back. If every backend fails the call
+    raises ConnectionError, which the routes already answer with the "Ollama is not running" page.
+    """
+
+    def __init__(self, backends, health_interval=10.0):
+        self._members = [_Member(b) for b in backends]
+        if not self._members:
+            raise ValueError("LLMPool needs at least one backend")
+        self.health_interval = health_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.failovers = 0
+        self.exhausted = 0
+
+    def _start(self):
+        # Started lazily so importing the app spawns no threads
+        with self._lock:
+            if self._thread is None and len(self._members) > 1:
+                self._thread = threading.Thread(target=self._check_health, name="llm-health", daemon=True)
+                self._thread.start()
+
+    def _check_health(self):
+        while True:
+            time.sleep(self.health_interval)
+            for member in self._members:
+                try:
+                    member.backend.ping()
+                except Exception as e:
+                    if member.healthy:
+                        print(f"LLM backend {member.backend.name} failed its health check: {_describe(e)}")
+                    member.healthy = False
+                    member.last_error = _describe(e)
+                else:
+                    if not member.healthy:
+                        print(f"LLM backend {member.backend.name} is back")
+                    member.healthy = True
+
+    def _order(self):
+        """Backends to try: healthy ones by requests in flight, then the ones marked down (last resort)."""
+        self._start()
+        with self._lock:
+            return sorted(self._members, key=lambda m: (not m.healthy, m.outstanding, m.requests))
+
+    def _begin(self, member):
+        with self._lock:
+            member.outstanding += 1
+            member.requests += 1
+
+    def _abandon(self, member):
+        # The call ended without telling anything about the backend's health
+        with self._lock:
+            member.outstanding -= 1
+
+    def _end(self, member, error=None):
+        with self._lock:
+            member.outstanding -= 1
+            if error is not None:
+                member.failures += 1
+                member.last_error = _describe(error)
+            member.healthy = error is None
+
+    def _failed(self, member, error, last):
+        print(f"LLM backend {member.backend.name} failed: {_describe(error)}" + ("" if last else "; trying the next one"))
+        self._end(member, error)
+        with self._lock:
+            if last:
+                self.exhausted += 1
+            else:
+                self.failovers += 1
+
+    def chat(self, stream=False, **kwargs):
+        if stream:
+            return self._chat_stream(kwargs)
+        order = self._order()
+        for i, member in enumerate(order):
+            self._begin(member)
+            try:
+                response = member.backend.chat(**kwargs)
+            except FAILOVER_ERRORS as e:
+                if _client_error(e):
+                    self._abandon(member)
+                    raise
+                self._failed(member, e, i == len(order) - 1)
+                error = e
+                continue
+            except BaseException:
+                self._abandon(member)
+                raise
+            self._end(member)
+            return response
+        raise ConnectionError(f"No LLM backend available: {_describe(error)}")
+
+    def _chat_stream(self, kwargs):
+        order = self._order()
+        for i, member in enumerate(order):
+            self._begin(member)
+            chunks = None
+            try:
+                chunks = member.backend.chat(stream=True, **kwargs)
+                first = next(chunks, None)
+            except FAILOVER_ERRORS as e:
+                if _client_error(e):
+                    self._abandon(member)
+                    raise
+                self._failed(member, e, i == len(order) - 1)
+                error = e
+                continue
+            except BaseException:
+                self._abandon(member)
+                raise
+            try:
+                if first is not None:
+                    yield first
+                    yield from chunks
+            finally:
+                chunks.close()
+                self._end(member)
+            return
+        raise ConnectionError(f"No LLM backend available: {_describe(error)}")
+
+    async def achat(self, stream=False, **kwargs):
+        """Async counterpart of chat(): await it for the response, or for the chunk stream with stream=True."""
+        if stream:
+            return self._achat_stream(kwargs)
+        order = self._order()
+        for i, member in enumerate(order):
+            self._begin(member)
+            try:
+                response = await member.backend.achat(**kwargs)
+            except FAILOVER_ERRORS as e:
+                if _client_error(e):
+                    self._abandon(member)
+                    raise
+                self._failed(member, e, i == len(order) - 1)
+                error = e
+                continue
+            except BaseException:
+                self._abandon(member)
+                raise
+            self._end(member)
+            return response
+        raise ConnectionError(f"No LLM backend available: {_describe(error)}")
+
+    async def _achat_stream(self, kwargs):
+        order = self._order()
+        for i, member in enumerate(order):
+            self._begin(member)
+            chunks = None
+            try:
+                chunks = await member.backend.achat(stream=True, **kwargs)
+                first = await anext(chunks, None)
+            except FAILOVER_ERRORS as e:
+                if _client_error(e):
+                    self._abandon(member)
+                    raise
+                self._failed(member, e, i == len(order) - 1)
+                error = e
+                continue
+            except BaseException:
+                self._abandon(member)
+                raise
+            try:
+                if first is not None:
+                    yield first
+                    async for chunk in chunks:
+                        yield chunk
+            finally:
+                await chunks.aclose()
+                self._end(member)
+            return
+        raise ConnectionError(f"No LLM backend available: {_describe(error)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "failovers": self.failovers,
+                "all_backends_failed": self.exhausted,
+                "backends": [
+                    {
+                        "name": m.backend.name,
+                        "healthy": m.healthy,
+                        "outstanding": m.outstanding,
+                        "requests": m.requests,
+                        "failures": m.failures,
+                        "last_error": m.last_error,
+                    }
+                    for m in self._members
+                ],
+            }
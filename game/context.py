@@ -0,0 +1,190 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CHARS_PER_TOKEN = 4  # rough average for English text with llama-style tokenizers
+MESSAGE_OVERHEAD = 4  # role and template tokens around each chat message
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def first_sentence(text, max_chars=200):
+    sentence = _SENTENCE_END.split(text.strip(), 1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[: max_chars - 3].rstrip() + "..."
+
+
+def _truncate(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[: max_chars - 3].rstrip() + "..."
+
+
+def extractive_summary(messages, max_tokens, clean_text=None):
+    """
+    One line per turn in messages: the player's choice and the first sentence of the scene it
+    led to. Over max_tokens, keeps the first line (how this stretch began) and the latest ones.
+    """
+    clean_text = clean_text or (lambda text: text)
+    lines = []
+    choice = None
+    for message in messages:
+        if message["role"] == "user":
+            choice = message["content"].strip()
+        elif message["role"] == "assistant":
+            scene = first_sentence(clean_text(message["content"]))
+            lines.append(f"{choice} -> {scene}" if choice else scene)
+            choice = None
+    if not lines:
+        return ""
+    kept = [lines[-1]]
+    used = estimate_tokens(lines[0]) + estimate_tokens(lines[-1])
+    for line in reversed(lines[1:-1]):
+        used += estimate_tokens(line) + 1
+        if used > max_tokens:
+            kept.append("...")
+            break
+        kept.append(line)
+    if len(lines) > 1:
+        kept.append(lines[0])
+    return _truncate(" ".join(reversed(kept)), max_tokens)
+
+
+class ContextWindow:
+    """
+    Builds the messages for a story turn within a token budget instead of a fixed message count:
+    the pinned messages (system prompt and the opening setup), a summary of the turns that no
+    longer fit, then as many of the latest messages as fit, then the player's message.
+
+    The summary is extractive by default (computed from the history on every turn, nothing
+    stored). With summarize(previous_summary, messages) -> text, older turns are folded into a
+    rolling model-written summary on a background thread, summarize_every messages at a time;
+    turns not folded in yet are covered extractively meanwhile, so a turn never waits on it.
+    Token counts are estimates (CHARS_PER_TOKEN).
+
+    The window start moves in steps of evict_step messages rather than one turn at a time, so for
+    several turns in a row the prompt only grows at the end (same pinned messages, same summary,
+    same older turns): the prefix Ollama keeps in its prompt cache stays valid between turns.
+    """
+
+    def __init__(self, max_tokens=1536, summary_tokens=300, pinned=2, clean_text=None, summarize=None,
+                 summarize_every=4, evict_step=6, max_sessions=1000):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.pinned = pinned
+        self.clean_text = clean_text
+        self._summarize = summarize
+        self.summarize_every = summarize_every
+        self.evict_step = evict_step
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()  # session key -> (number of older messages covered, summary)
+        self._pending = set()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="story-summary") if summarize else None
+        self.builds = 0
+        self.summarized_builds = 0
+        self.prompt_tokens_total = 0
+        self.prompt_tokens_max = 0
+        self.summaries_written = 0
+        self.summary_failures = 0
+
+    def build(self, history, player_text, key=None):
+        """Messages to send for the player's next message (history: full chat, key: for the rolling summary)."""
+        pinned = history[: self.pinned] if history and history[0]["role"] == "system" else history[:0]
+        body = history[len(pinned) :]
+        user = {"role": "user", "content": player_text}
+        fixed = sum(message_tokens(m) for m in pinned) + message_tokens(user)
+        budget = self.max_tokens - fixed - self.summary_tokens - MESSAGE_OVERHEAD
+
+        # Newest messages that fit; the last scene (what the player is answering) always goes in
+        start = len(body)
+        used = 0
+        while start > 0:
+            cost = message_tokens(body[start - 1])
+            if used + cost > budget and start < len(body):
+                break
+            used += cost
+            start -= 1
+        if start > 0 and self.evict_step > 1:
+            start = min(-(-start // self.evict_step) * self.evict_step, len(body) - 1)
+
+        messages = list(pinned)
+        if start > 0:
+            summary = self._summary(key, body[:start])
+            messages.append({"role": "system", "content": f"Story so far (earlier chapters): {summary}"})
+        messages.extend(body[start:])
+        messages.append(user)
+
+        total = sum(message_tokens(m) for m in messages)
+        with self._lock:
+            self.builds += 1
+            self.summarized_builds += start > 0
+            self.prompt_tokens_total += total
+            self.prompt_tokens_max = max(self.prompt_tokens_max, total)
+        return messages
+
+    def _summary(self, key, older):
+        if self._summarize is None or key is None:
+            return extractive_summary(older, self.summary_tokens, self.clean_text)
+        with self._lock:
+            covered, text = self._summaries.get(key, (0, ""))
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+        if covered > len(older):
+            covered, text = 0, ""
+        pending = older[covered:]
+        if len(pending) >= self.summarize_every:
+            self._schedule(key, text, older, covered)
+        if not pending:
+            return text
+        tail_tokens = max(self.summary_tokens - estimate_tokens(text), self.summary_tokens // 4)
+        tail = extractive_summary(pending, tail_tokens, self.clean_text)
+        return f"{text} Then: {tail}" if text else tail
+
+    def _schedule(self, key, previous, older, covered):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._pool.submit(self._update, key, previous, list(older), covered)
+
+    def _update(self, key, previous, older, covered):
+        try:
+            text = _truncate(self._summarize(previous, older[covered:]).strip(), self.summary_tokens)
+            with self._lock:
+                self._summaries[key] = (len(older), text)
+                self._summaries.move_to_end(key)
+                while len(self._summaries) > self.max_sessions:
+                    self._summaries.popitem(last=False)
+                self.summaries_written += 1
+        except Exception as e:
+            print(f"Story summary failed: {e}")
+            self.summary_failures += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def discard(self, key):
+        with self._lock:
+            self._summaries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_tokens": self.max_tokens,
+                "summary": "model" if self._summarize else "extractive",
+                "builds": self.builds,
+                "summarized_builds": self.summarized_builds,
+                "prompt_tokens_avg": round(self.prompt_tokens_total / self.builds) if self.builds else None,
+                "prompt_tokens_max": self.prompt_tokens_max,
+                "summaries_written": self.summaries_written,
+                "summary_failures": self.summary_failures,
+            }
@@ -0,0 +1,308 @@
+import re
+from functools import lru_cache
+
+# Precompiled patterns for the storyteller's reply format (see the system prompt in app.py):
+# scene text, numbered options ("1. ...", "2) ...", "3- ..."), then a last line "Chapter: <title>".
+_OPTION_LINE = re.compile(r"^\s*(\d+)[\.\)\-]\s*(.*)$")
+_CHAPTER_LINE = re.compile(r"^\s*Chapter:\s*.+$", re.IGNORECASE)
+_CHAPTER_TITLE = re.compile(r"^Chapter:\s*(.+)$", re.IGNORECASE)
+_SCENE_PREFIX = re.compile(r"^\s*scene\s*[:\-]\s*", re.IGNORECASE)
+_BOLD = re.compile(r"\*\*(.*?)\*\*")
+
+MAX_TITLE_CHARS = 100
+PARSE_CACHE_SIZE = 4096
+
+
+def strip_markdown_bold(text):
+    return _BOLD.sub(r"\1", text) if "**" in text else text
+
+
+class ParsedScene:
+    """
+    One assistant reply split into its parts. options maps option number -> text; treat it
+    (and the rest) as read-only, since parse_scene() hands the same object to every caller.
+    """
+
+    __slots__ = ("scene_text", "options", "chapter_title", "warnings")
+
+    def __init__(self, scene_text, options, chapter_title, warnings):
+        self.scene_text = scene_text
+        self.options = options
+        self.chapter_title = chapter_title
+        self.warnings = warnings
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_scene(text):
+    """
+    Parse an assistant reply in one pass over its lines: the scene text (option lines, bold markers,
+    trailing 'Chapter:' lines and a leading 'Scene:' removed), the options, the chapter title (the
+    last 'Chapter:' line) and warnings about format problems. Memoized by text, so re-rendering or
+    exporting a history does not parse its messages again.
+    """
+    if not text:
+        return ParsedScene("", {}, None, ("empty reply",))
+
+    options = {}
+    duplicates = []
+    scene_lines = []
+    chapter_title = None
+    chapter_line = None  # index among non-empty lines of the last 'Chapter:' line
+    last_line = -1
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            scene_lines.append(line)
+            continue
+        last_line += 1
+        # Cheap first-character checks before the regexes: most lines are plain scene text
+        if stripped[:8].lower() == "chapter:":
+            m = _CHAPTER_TITLE.match(stripped)
+            if m:
+                title = m.group(1).strip().rstrip(".").strip()
+                chapter_title = title[:MAX_TITLE_CHARS] if title else None
+                chapter_line = last_line
+        m = _OPTION_LINE.match(line) if stripped[0].isdigit() else None
+        if m:
+            num = int(m.group(1))
+            if num in options:
+                duplicates.append(num)
+            options[num] = strip_markdown_bold(m.group(2).strip())
+        else:
+            scene_lines.append(strip_markdown_bold(line))
+
+    # Same result as stripping the joined text: drop blank lines and whitespace at both ends
+    while scene_lines and not scene_lines[-1].strip():
+        scene_lines.pop()
+    while scene_lines and not scene_lines[0].strip():
+        scene_lines.pop(0)
+    if scene_lines:
+        scene_lines[0] = scene_lines[0].lstrip()
+        scene_lines[-1] = scene_lines[-1].rstrip()
+    while scene_lines and _CHAPTER_LINE.match(scene_lines[-1]):
+        scene_lines.pop()
+    scene_text = "\n".join(scene_lines).strip()
+    scene_text = _SCENE_PREFIX.sub("", scene_text, count=1).strip()
+
+    warnings = []
+    if not scene_text:
+        warnings.append("no scene text")
+    if not options:
+        warnings.append("no options")
+    elif sorted(options) != list(range(1, len(options) + 1)):
+        warnings.append(f"options numbered {sorted(options)}")
+    if duplicates:
+        warnings.append(f"repeated option numbers {duplicates}")
+    if chapter_line is None:
+        warnings.append("no chapter line")
+    elif chapter_line != last_line:
+        warnings.append("chapter line is not last")
+    return ParsedScene(scene_text, options, chapter_title, tuple(warnings))
+
+
+def parse_cache_stats():
+    info = parse_scene.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "entries": info.currsize,
+        "max_entries": info.maxsize,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": round(info.hits / lookups, 3) if lookups else None,
+    }
+
+
+# === Structured (JSON) replies ===
+# JSON schema passed as Ollama's `format` in structured mode; the reply is turned back into the text
+# layout above (format_scene_text), so history, parsing and exports are the same in both modes.
+STORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scene": {"type": "string"},
+        "options": {"type": "array", "items": {"type": "string"}, "minItems": 2, "maxItems": 3},
+        "chapter": {"type": "string"},
+    },
+    "required": ["scene", "options", "chapter"],
+}
+
+# Parser states
+_OBJECT, _KEY, _COLON, _VALUE, _STRING, _ARRAY, _SKIP, _END = range(8)
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def _one_line(text):
+    return " ".join(text.split())
+
+
+def format_scene_text(scene, options, chapter):
+    """The plain-text reply layout: scene, numbered options, then 'Chapter: <title>'."""
+    parts = [scene]
+    options = [_one_line(o) for o in options if o.strip()]
+    if options:
+        parts.append("\n".join(f"{i}. {option}" for i, option in enumerate(options, 1)))
+    if chapter and chapter.strip():
+        parts.append(f"Chapter: {_one_line(chapter)}")
+    return "\n\n".join(parts)
+
+
+class SceneJSONParser:
+    """
+    Tolerant incremental parser for a streamed {"scene", "options", "chapter"} reply.
+
+    feed(chunk) returns the newly decoded characters of the "scene" string, so a streamed
+    reply can be shown while it is written. Anything before the opening brace is ignored,
+    values of other types are skipped, and a reply cut off mid-way (e.g. at num_predict)
+    keeps what was read: the partial scene and the options completed so far.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.complete = False
+        self._state = None  # waiting for the opening brace
+        self._key = None
+        self._chars = []
+        self._in_array = False
+        self._items = None
+        self._escape = None  # None, "" after a backslash, or the hex digits of a \u escape
+        self._high_surrogate = None
+        self._depth = 0
+        self._skip_string = False
+        self._skip_escape = False
+
+    def feed(self, chunk):
+        out = []
+        for ch in chunk:
+            state = self._state
+            if state == _STRING or state == _KEY:
+                decoded = self._string_char(ch)
+                if decoded and state == _STRING and not self._in_array and self._key == "scene":
+                    out.append(decoded)
+            elif state == _SKIP:
+                self._skip_char(ch)
+            elif state is None:
+                if ch == "{":
+                    self._state = _OBJECT
+            elif state == _COLON:
+                if ch == ":":
+                    self._state = _VALUE
+            elif state == _VALUE:
+                if ch == '"':
+                    self._state, self._chars, self._in_array = _STRING, [], False
+                elif ch == "[":
+                    self._state, self._items, self._in_array = _ARRAY, [], True
+                elif not ch.isspace():
+                    self._start_skip(ch)
+            elif state == _OBJECT or state == _ARRAY:
+                self._container_char(ch)
+        return "".join(out)
+
+    def _container_char(self, ch):
+        # Between the members of the top-level object or the items of an array
+        if self._state == _OBJECT:
+            if ch == '"':
+                self._state, self._chars = _KEY, []
+            elif ch == "}":
+                self._state, self.complete = _END, True
+        elif ch == '"':
+            self._state, self._chars = _STRING, []
+        elif ch == "]":
+            self.fields[self._key] = self._items
+            self._state, self._items, self._in_array = _OBJECT, None, False
+        elif not (ch.isspace() or ch == ","):
+            self._start_skip(ch)
+
+    def _string_char(self, ch):
+        # Returns the decoded text this character completes ("" while inside an escape)
+        if self._escape is not None:
+            if self._escape == "" and ch != "u":
+                self._escape = None
+                return self._append(_ESCAPES.get(ch, ch))
+            self._escape += ch
+            if len(self._escape) < 5:
+                return ""
+            try:
+                code = int(self._escape[1:], 16)
+            except ValueError:
+                code = 0xFFFD
+            self._escape = None
+            if 0xD800 <= code < 0xDC00:
+                self._high_surrogate = code
+                return ""
+            if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            return self._append(chr(code) if not 0xD800 <= code < 0xE000 else "\ufffd")
+        if ch == "\\":
+            self._escape = ""
+            return ""
+        if ch == '"':
+            self._end_string()
+            return ""
+        return self._append(ch)
+
+    def _append(self, text):
+        self._chars.append(text)
+        return text
+
+    def _end_string(self):
+        text = "".join(self._chars)
+        self._chars = []
+        if self._state == _KEY:
+            self._key, self._state = text, _COLON
+        elif self._in_array:
+            self._items.append(text)
+            self._state = _ARRAY
+        else:
+            self.fields[self._key] = text
+            self._state = _OBJECT
+
+    def _start_skip(self, ch):
+        # A value that is not a string or array of strings (number, object, ...): skip it
+        self._state, self._depth, self._skip_string, self._skip_escape = _SKIP, 0, False, False
+        self._skip_char(ch)
+
+    def _skip_char(self, ch):
+        if self._skip_string:
+            if self._skip_escape:
+                self._skip_escape = False
+            elif ch == "\\":
+                self._skip_escape = True
+            elif ch == '"':
+                self._skip_string = False
+        elif ch == '"':
+            self._skip_string = True
+        elif ch in "[{":
+            self._depth += 1
+        elif ch in "]}" and self._depth > 0:
+            self._depth -= 1
+        elif self._depth == 0 and ch in ",]}":
+            # End of the skipped value; the character belongs to the enclosing array or object
+            self._state = _ARRAY if self._in_array else _OBJECT
+            self._container_char(ch)
+
+    def result(self):
+        """(scene, options, chapter) read so far, including a scene cut off mid-string; None if no scene was seen."""
+        fields = dict(self.fields)
+        if self._state == _STRING and not self._in_array and self._key == "scene":
+            fields["scene"] = "".join(self._chars)
+        if self._in_array and self._key == "options" and "options" not in fields:
+            fields["options"] = list(self._items)
+        scene = fields.get("scene")
+        if not isinstance(scene, str):
+            return None
+        options = fields.get("options")
+        options = [o for o in options if isinstance(o, str)] if isinstance(options, list) else []
+        chapter = fields.get("chapter") if isinstance(fields.get("chapter"), str) else ""
+        return scene, options, chapter
+
+
+def structured_reply_text(parser, raw):
+    """
+    The plain-text reply for a structured reply read by parser (raw: the whole reply) and how it
+    was obtained: "json" (complete object), "repaired" (cut off, completed from what was read) or
+    "fallback" (no scene field: raw is used as is and parsed like a plain-text reply).
+    """
+    parsed = parser.result()
+    if parsed is None or not parsed[0].strip():
+        return raw, "fallback"
+    return format_scene_text(*parsed), "json" if parser.complete else "repaired"
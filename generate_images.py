@@ -4,92 +4,27 @@ import shutil
 import os
 import random
 import hashlib
-from urllib import request
-
-# Workflow JSON for fables / storybook scene generation
-prompt_text = '''{
-  "7": {
-    "inputs": {
-      "seed": 0,
-      "steps": 35,
-      "cfg": 8,
-      "sampler_name": "euler",
-      "scheduler": "simple",
-      "denoise": 1,
-      "model": ["20", 0],
-      "positive": ["15", 0],
-      "negative": ["16", 0],
-      "latent_image": ["9", 0]
-    },
-    "class_type": "KSampler",
-    "_meta": {"title": "KSampler"}
-  },
-  "9": {
-    "inputs": {
-      "width": 1280,
-      "height": 1280,
-      "batch_size": 1
-    },
-    "class_type": "EmptyLatentImage",
-    "_meta": {"title": "Empty Latent Image"}
-  },
-  "12": {
-    "inputs": {
-      "samples": ["7", 0],
-      "vae": ["20", 2]
-    },
-    "class_type": "VAEDecode",
-    "_meta": {"title": "VAE Decode"}
-  },
-  "15": {
-    "inputs": {
-      "text": "",
-      "clip": ["20", 1]
-    },
-    "class_type": "CLIPTextEncode",
-    "_meta": {"title": "CLIP Text Encode (Positive Prompt)"}
-  },
-  "16": {
-    "inputs": {
-      "text": "",
-      "clip": ["20", 1]
-    },
-    "class_type": "CLIPTextEncode",
-    "_meta": {"title": "CLIP Text Encode (Negative Prompt)"}
-  },
-  "17": {
-    "inputs": {
-      "filename_prefix": "ComfyUI",
-      "images": ["12", 0]
-    },
-    "class_type": "SaveImage",
-    "_meta": {"title": "Save Image"}
-  },
-  "18": {
-    "inputs": {
-      "images": ["12", 0]
-    },
-    "class_type": "PreviewImage",
-    "_meta": {"title": "Preview Image"}
-  },
-  "20": {
-    "inputs": {
-      "ckpt_name": "anything-v5.safetensors"
-    },
-    "class_type": "CheckpointLoaderSimple",
-    "_meta": {"title": "Load Checkpoint"}
-  }
-}'''
-
-COMFYUI_OUTPUT_DIR = r"C:\Users\nirca\repos\rpg_dungeon_ai\assets"
+import uuid
+import threading
+from urllib import request, parse
+from workflows import get_workflow
+
+try:
+    import websocket  # websocket-client: push completion events from ComfyUI's /ws
+except ImportError:
+    websocket = None
+
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://127.0.0.1:8188").rstrip("/")
 TARGET_DIR = r"C:\Users\nirca\repos\rpg_dungeon_ai\static\images"
 
-def queue_prompt(workflow):
-    """Queue a prompt to ComfyUI and return the result"""
+def queue_prompt(workflow, client_id=None):
+    """Queue a prompt to ComfyUI and return the result (client_id: the websocket that gets its events)"""
     payload = {"prompt": workflow}
+    if client_id:
+        payload["client_id"] = client_id
     data = json.dumps(payload).encode("utf-8")
     req = request.Request(
-        "http://127.0.0.1:8188/prompt",
+        f"{COMFYUI_URL}/prompt",
         data=data,
         headers={"Content-Type": "application/json"}
     )
@@ -101,11 +36,29 @@ def queue_prompt(workflow):
         print(f"Error queuing prompt: {e}")
         return None
 
+def cancel_prompt(prompt_id):
+    """Drop a prompt from ComfyUI's queue, or interrupt it if it is already running. Returns True on success."""
+    try:
+        with request.urlopen(f"{COMFYUI_URL}/queue", timeout=5) as response:
+            queue = json.loads(response.read().decode())
+        running = any(item[1] == prompt_id for item in queue.get("queue_running", []))
+        endpoint, payload = ("/interrupt", {"prompt_id": prompt_id}) if running else ("/queue", {"delete": [prompt_id]})
+        req = request.Request(
+            f"{COMFYUI_URL}{endpoint}",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        request.urlopen(req, timeout=5).read()
+        return True
+    except Exception as e:
+        print(f"Error cancelling prompt {prompt_id}: {e}")
+        return False
+
 def check_comfyui_status():
     """Check if ComfyUI is running and accessible"""
     try:
         # Try the queue endpoint first (more reliable)
-        req = request.Request("http://127.0.0.1:8188/queue")
+        req = request.Request(f"{COMFYUI_URL}/queue")
         response = request.urlopen(req, timeout=5)
         print("ComfyUI is running and accessible")
         return True
@@ -113,7 +66,7 @@ def check_comfyui_status():
         print(f"ComfyUI connection failed: {e}")
         # Try alternative endpoint
         try:
-            req = request.Request("http://127.0.0.1:8188/")
+            req = request.Request(f"{COMFYUI_URL}/")
             response = request.urlopen(req, timeout=5)
             print("ComfyUI is running (found via root endpoint)")
             return True
@@ -121,48 +74,253 @@ def check_comfyui_status():
             print(f"ComfyUI root endpoint also failed: {e2}")
             return False
 
-def wait_for_completion(prompt_id, max_wait_time=60):
-    """Wait for the generation to complete by checking the history"""
-    if not prompt_id:
+class ComfyUIHealthMonitor:
+    """
+    Cached ComfyUI liveness with a circuit breaker, so image jobs don't each probe the server.
+
+    A background thread probes /queue: every `interval` seconds while ComfyUI is up, and with
+    exponential backoff (1s doubling up to `max_backoff`) while it is down. While the circuit
+    is open, available() returns False immediately; the next successful probe closes it again.
+    Real request failures reported via report_failure() trip the circuit after
+    `failure_threshold` in a row, without waiting for the next scheduled probe.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, interval=15.0, max_backoff=60.0, failure_threshold=3, probe_timeout=2.0):
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.probe_timeout = probe_timeout
+        self.state = None  # unknown until the first probe
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._backoff = 1.0
+        self._consecutive_failures = 0
+        self.last_change = None
+        self.probes = 0
+        self.probe_failures = 0
+        self.trips = 0
+        self.fast_failures = 0
+
+    def probe(self):
+        """One cheap liveness request; updates and returns the cached up/down state."""
+        self.probes += 1
+        try:
+            request.urlopen(request.Request(f"{COMFYUI_URL}/queue"), timeout=self.probe_timeout).close()
+            ok = True
+        except Exception:
+            ok = False
+            self.probe_failures += 1
+        with self._lock:
+            if ok:
+                self._consecutive_failures = 0
+                self._backoff = 1.0
+                self._set_state(self.CLOSED)
+            else:
+                self._trip()
+        return ok
+
+    def _set_state(self, state):
+        if state != self.state:
+            if self.state is not None:
+                print(f"ComfyUI circuit {self.state} -> {state}")
+            self.state = state
+            self.last_change = time.time()
+
+    def _trip(self):
+        if self.state != self.OPEN:
+            self.trips += 1
+        self._set_state(self.OPEN)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self.state == self.OPEN:
+                    delay = self._backoff
+                    self._backoff = min(self._backoff * 2, self.max_backoff)
+                else:
+                    delay = self.interval
+            self._wake.wait(delay)
+            self._wake.clear()
+            with self._lock:
+                if self.state == self.OPEN:
+                    self._set_state(self.HALF_OPEN)
+            self.probe()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="comfyui-health", daemon=True)
+            self._thread.start()
+
+    def available(self):
+        """Cached liveness; only the very first call waits on a probe."""
+        if self.state is None:
+            self.probe()
+        self._ensure_started()
+        if self.state == self.CLOSED:
+            return True
+        self.fast_failures += 1
         return False
-    
-    start_time = time.time()
-    while time.time() - start_time < max_wait_time:
+
+    def report_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def report_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures < self.failure_threshold:
+                return
+            self._trip()
+        self._wake.set()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "up": 1 if self.state == self.CLOSED else 0,
+            "last_change": self.last_change,
+            "backoff_seconds": self._backoff,
+            "consecutive_failures": self._consecutive_failures,
+            "probes": self.probes,
+            "probe_failures": self.probe_failures,
+            "trips": self.trips,
+            "fast_failures": self.fast_failures,
+        }
+
+
+comfyui_health = ComfyUIHealthMonitor()
+
+
+def open_progress_socket(client_id):
+    """
+    Connect to ComfyUI's websocket before queueing a prompt so no completion event is missed.
+    ComfyUI keeps one socket per clientId (a second connection replaces the first), so every
+    generation uses its own id, passed to queue_prompt as well.
+    Returns None when websocket-client is not installed or the socket cannot be opened;
+    wait_for_completion then falls back to adaptive polling.
+    """
+    if websocket is None:
+        return None
+    ws_url = COMFYUI_URL.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+    try:
+        return websocket.create_connection(f"{ws_url}/ws?clientId={client_id}", timeout=5)
+    except Exception as e:
+        print(f"ComfyUI websocket unavailable, polling instead: {e}")
+        return None
+
+
+def fetch_history(prompt_id):
+    """History entry for prompt_id, or None while ComfyUI has not finished it."""
+    req = request.Request(f"{COMFYUI_URL}/history/{parse.quote(prompt_id)}")
+    response = request.urlopen(req, timeout=5)
+    history = json.loads(response.read().decode())
+    return history.get(prompt_id)
+
+
+def history_output_images(entry):
+    """Saved images ({filename, subfolder, type}) listed in a history entry; previews are skipped."""
+    images = []
+    for node_output in (entry.get("outputs") or {}).values():
+        for image in node_output.get("images") or []:
+            if image.get("type", "output") == "output":
+                images.append(image)
+    return images
+
+
+def _wait_for_executed_event(ws, prompt_id, deadline):
+    """Block on websocket messages until ComfyUI reports prompt_id finished; False on error/timeout."""
+    while time.time() < deadline:
+        ws.settimeout(max(0.1, deadline - time.time()))
+        message = ws.recv()
+        if not isinstance(message, str):
+            continue  # binary preview frames
+        event = json.loads(message)
+        data = event.get("data") or {}
+        if data.get("prompt_id") != prompt_id:
+            continue
+        kind = event.get("type")
+        if kind == "executing" and data.get("node") is None:
+            return True
+        if kind == "execution_success":
+            return True
+        if kind in ("execution_error", "execution_interrupted"):
+            return False
+    return False
+
+
+def wait_for_completion(prompt_id, max_wait_time=60, ws=None):
+    """
+    Wait for ComfyUI to finish prompt_id and return the saved output images from its history
+    entry (list of {filename, subfolder, type}); None on failure or timeout.
+
+    With a websocket from open_progress_socket() this wakes on the completion event itself;
+    otherwise /history is polled, starting fast and backing off to at most once a second.
+    """
+    if not prompt_id:
+        return None
+
+    deadline = time.time() + max_wait_time
+    if ws is not None:
         try:
-            req = request.Request(f"http://127.0.0.1:8188/history/{prompt_id}")
-            response = request.urlopen(req, timeout=5)
-            history = json.loads(response.read().decode())
-            
-            if prompt_id in history:
-                return True
-                
+            if not _wait_for_executed_event(ws, prompt_id, deadline):
+                return None
+        except Exception as e:
+            print(f"ComfyUI websocket error, polling instead: {e}")
+        finally:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    interval = 0.1
+    while True:
+        try:
+            entry = fetch_history(prompt_id)
+            if entry is not None:
+                status = entry.get("status") or {}
+                if status.get("status_str") == "error":
+                    return None
+                return history_output_images(entry) or None
         except Exception:
             pass
-        
-        time.sleep(2)
-    
-    return False
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, 1.0)
 
-def move_generated_files(prefix, target_filename):
-    """Move generated files from ComfyUI output to target directory with specific name"""
-    if not os.path.exists(TARGET_DIR):
-        os.makedirs(TARGET_DIR)
-    
-    # Find the most recent file with the prefix
-    matching_files = []
-    for filename in os.listdir(COMFYUI_OUTPUT_DIR):
-        if filename.startswith(prefix) and filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            filepath = os.path.join(COMFYUI_OUTPUT_DIR, filename)
-            matching_files.append((filepath, os.path.getmtime(filepath)))
-    
-    if matching_files:
-        # Get the most recent file
-        most_recent_file = max(matching_files, key=lambda x: x[1])[0]
-        dst = os.path.join(TARGET_DIR, target_filename)
-        shutil.move(most_recent_file, dst)
+def download_output_image(image, target_filename):
+    """
+    Stream one saved ComfyUI output ({filename, subfolder, type} from history) through the
+    /view API into TARGET_DIR/target_filename. Bytes go to a temp file that is renamed into
+    place, so readers never see a partial image and ComfyUI may run on another machine.
+    """
+    os.makedirs(TARGET_DIR, exist_ok=True)
+    query = parse.urlencode({
+        "filename": image["filename"],
+        "subfolder": image.get("subfolder", ""),
+        "type": image.get("type", "output"),
+    })
+    dst = os.path.join(TARGET_DIR, target_filename)
+    tmp = f"{dst}.{uuid.uuid4().hex}.part"
+    try:
+        with request.urlopen(f"{COMFYUI_URL}/view?{query}", timeout=30) as response, open(tmp, "wb") as f:
+            shutil.copyfileobj(response, f, 64 * 1024)
+        os.replace(tmp, dst)
         return True
-    
-    return False
+    except Exception as e:
+        print(f"Error downloading {image.get('filename')}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
 
 def sanitize_filename(text, max_length=50):
     """Create a safe filename from text"""
@@ -175,18 +333,43 @@ def sanitize_filename(text, max_length=50):
     
     return f"{clean_text}_{text_hash}.png"
 
-def generate_image_from_text(scene_description):
+def build_generation_prompt(scene_description, workflow="fables", profile=None, width=None, height=None,
+                            steps=None, batch_size=None):
+    """
+    Request-ready graph for one generation: the pre-parsed workflow patched with the scene
+    description as the main prompt, the template negative prompt, a random seed for variety
+    and a unique filename prefix.
+    """
+    filename_prefix = f"scene_{int(time.time())}_{random.randint(1000, 9999)}"
+    return get_workflow(workflow).build(
+        scene_description,
+        seed=random.randint(0, 2**32 - 1),
+        filename_prefix=filename_prefix,
+        profile=profile,
+        width=width,
+        height=height,
+        steps=steps,
+        batch_size=batch_size,
+    )
+
+
+def variant_filename(image_filename, index):
+    """Name for the index-th image of a batched generation (index 0 keeps the cached name)."""
+    if index == 0:
+        return image_filename
+    stem, ext = os.path.splitext(image_filename)
+    return f"{stem}_v{index + 1}{ext}"
+
+
+def generate_image_from_text(scene_description, workflow="fables", profile=None, width=None, height=None, steps=None):
     """
     Generate an image from scene description text.
+    workflow names a template from workflows.WORKFLOWS; profile ("quality", "fast", "batch")
+    and explicit width/height/steps choose the cost of this one request.
     Returns the relative URL path to the generated image.
     """
     print(f"Generating image for: {scene_description[:50]}...")
     
-    # Check if ComfyUI is running
-    if not check_comfyui_status():
-        print("ComfyUI is not running. Skipping image generation.")
-        return None
-    
     # Create filename from scene description
     image_filename = sanitize_filename(scene_description)
     image_path = os.path.join(TARGET_DIR, image_filename)
@@ -196,47 +379,44 @@ def generate_image_from_text(scene_description):
         print(f"Using cached image: {image_filename}")
         return f"/static/images/{image_filename}"
     
+    # Fail fast while the ComfyUI circuit is open (cached state, no probe per image)
+    if not comfyui_health.available():
+        print("ComfyUI is not running. Skipping image generation.")
+        return None
+    
     try:
-        # Prepare the workflow
-        prompt = json.loads(prompt_text)
-        
-        # Use the scene description as the main prompt (story content first, style already in from app)
-        prompt["15"]["inputs"]["text"] = scene_description.strip()
-        
-        # Negative prompt to avoid unwanted elements
-        prompt["16"]["inputs"]["text"] = """
-blurry, low quality, text, watermark, bad anatomy, modern objects, contemporary items
-"""
-        
-        # Random seed for variety
-        prompt["7"]["inputs"]["seed"] = random.randint(0, 2**32 - 1)
-        
-        # Unique filename prefix for this generation
-        filename_prefix = f"scene_{int(time.time())}_{random.randint(1000, 9999)}"
-        prompt["17"]["inputs"]["filename_prefix"] = filename_prefix
+        # Prepare the workflow (story content first, style already in from app)
+        prompt = build_generation_prompt(
+            scene_description, workflow=workflow, profile=profile, width=width, height=height, steps=steps
+        )
         
-        # Queue the prompt
-        result = queue_prompt(prompt)
+        # Subscribe to progress events first, then queue the prompt
+        client_id = uuid.uuid4().hex
+        ws = open_progress_socket(client_id)
+        result = queue_prompt(prompt, client_id)
         
         if result and "prompt_id" in result:
+            comfyui_health.report_success()
             prompt_id = result["prompt_id"]
             print(f"Image generation queued with ID: {prompt_id}")
             
-            # Wait for completion
-            if wait_for_completion(prompt_id):
-                time.sleep(1)  # Small delay to ensure file is written
-                
-                # Move the generated file to our target location
-                if move_generated_files(filename_prefix, image_filename):
+            # Wait for completion (history lists the exact output file once it is written)
+            output_images = wait_for_completion(prompt_id, ws=ws)
+            if output_images:
+                # Copy the generated file to our target location
+                if download_output_image(output_images[0], image_filename):
                     print(f"Image generated successfully: {image_filename}")
                     return f"/static/images/{image_filename}"
                 else:
-                    print("Failed to find generated image file")
+                    print("Failed to download generated image file")
                     return None
             else:
                 print("Image generation timed out")
                 return None
         else:
+            if ws is not None:
+                ws.close()
+            comfyui_health.report_failure()
             print("Failed to queue image generation")
             return None
             
@@ -253,10 +433,10 @@ def test_generation():
     
     # Test different endpoints to see which ones work
     endpoints_to_test = [
-        "http://127.0.0.1:8188/",
-        "http://127.0.0.1:8188/queue", 
-        "http://127.0.0.1:8188/system_stats",
-        "http://127.0.0.1:8188/history"
+        f"{COMFYUI_URL}/",
+        f"{COMFYUI_URL}/queue", 
+        f"{COMFYUI_URL}/system_stats",
+        f"{COMFYUI_URL}/history"
     ]
     
     for endpoint in endpoints_to_test:
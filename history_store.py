@@ -0,0 +1,213 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StaleHistory(Exception):
+    """Raised by append() when the stored history no longer has the length the turn was built on."""
+
+
+class HistoryStore:
+    """
+    Storage for per-game chat histories (lists of {"role", "content"} messages).
+
+    load() returns a private copy; changes are persisted with append() (only the new
+    messages of a turn) or replace(). Idle histories expire after ttl_seconds.
+
+    append(key, messages, expected_length) raises StaleHistory unless the stored history still
+    has expected_length messages, so of two processes answering the same turn only the first
+    one's reply is stored.
+    """
+
+    def load(self, key):
+        raise NotImplementedError
+
+    def append(self, key, messages, expected_length=None):
+        raise NotImplementedError
+
+    def replace(self, key, messages):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class MemoryHistoryStore(HistoryStore):
+    """In-process store with LRU eviction beyond max_sessions and an idle TTL (lost on restart)."""
+
+    def __init__(self, max_sessions=1000, ttl_seconds=24 * 3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._histories = OrderedDict()  # key -> (messages, last_used)
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expire(self, now):
+        while self._histories:
+            key, (_, last_used) = next(iter(self._histories.items()))
+            if now - last_used < self.ttl_seconds:
+                break
+            del self._histories[key]
+            self.expirations += 1
+
+    def _touch(self, key, messages):
+        now = time.monotonic()
+        self._histories[key] = (messages, now)
+        self._histories.move_to_end(key)
+        self._expire(now)
+        while len(self._histories) > self.max_sessions:
+            self._histories.popitem(last=False)
+            self.evictions += 1
+
+    def load(self, key):
+        with self._lock:
+            entry = self._histories.get(key)
+            if entry is None:
+                return []
+            self._touch(key, entry[0])
+            return list(entry[0])
+
+    def append(self, key, messages, expected_length=None):
+        with self._lock:
+            entry = self._histories.get(key)
+            stored = entry[0] if entry else []
+            if expected_length is not None and len(stored) != expected_length:
+                raise StaleHistory(key)
+            stored.extend(dict(m) for m in messages)
+            self._touch(key, stored)
+
+    def replace(self, key, messages):
+        with self._lock:
+            self._touch(key, [dict(m) for m in messages])
+
+    def delete(self, key):
+        with self._lock:
+            self._histories.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._histories),
+                "max_sessions": self.max_sessions,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Durable store in one SQLite file (WAL mode), shared by every worker process on the host.
+    Each message is one row, so a turn appends two rows instead of rewriting the history.
+    """
+
+    PURGE_EVERY = 200  # appends between idle-session purges
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._appends = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_key TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " session_key TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL,"
+                " PRIMARY KEY (session_key, seq))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def load(self, key):
+        rows = self._conn().execute(
+            "SELECT message FROM messages WHERE session_key = ? ORDER BY seq", (key,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _insert(self, conn, key, messages, first_seq):
+        conn.executemany(
+            "INSERT INTO messages (session_key, seq, message) VALUES (?, ?, ?)",
+            [(key, first_seq + i, json.dumps(m, ensure_ascii=False)) for i, m in enumerate(messages)],
+        )
+        conn.execute(
+            "INSERT INTO sessions (session_key, updated_at) VALUES (?, ?)"
+            " ON CONFLICT(session_key) DO UPDATE SET updated_at = excluded.updated_at",
+            (key, time.time()),
+        )
+
+    def append(self, key, messages, expected_length=None):
+        with self._transaction() as conn:
+            (last_seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) FROM messages WHERE session_key = ?", (key,)
+            ).fetchone()
+            # Checked inside the IMMEDIATE transaction: no other process can append in between
+            if expected_length is not None and last_seq + 1 != expected_length:
+                raise StaleHistory(key)
+            self._insert(conn, key, messages, last_seq + 1)
+        self._appends += 1
+        if self._appends % self.PURGE_EVERY == 0:
+            self.purge_expired()
+
+    def replace(self, key, messages):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE session_key = ?", (key,))
+            self._insert(conn, key, messages, 0)
+
+    def delete(self, key):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE session_key = ?", (key,))
+            conn.execute("DELETE FROM sessions WHERE session_key = ?", (key,))
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM messages WHERE session_key IN (SELECT session_key FROM sessions WHERE updated_at < ?)",
+                (cutoff,),
+            )
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+
+    def stats(self):
+        (sessions,) = self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()
+        return {"backend": "sqlite", "path": self.path, "sessions": sessions}
+
+
+def create_history_store(spec):
+    """'memory' or 'sqlite:///path/to/file.db' -> HistoryStore."""
+    if spec == "memory":
+        return MemoryHistoryStore()
+    if spec.startswith("sqlite:///"):
+        return SQLiteHistoryStore(spec[len("sqlite:///"):])
+    raise ValueError(f"unknown history store '{spec}' (use 'memory' or 'sqlite:///path')")
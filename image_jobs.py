@@ -0,0 +1,153 @@
+import hashlib
+import queue
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+REJECTED = "rejected"
+
+FINISHED_STATES = frozenset({DONE, FAILED, REJECTED})
+
+
+class ImageQueueFull(Exception):
+    """Raised by ImageJobScheduler.submit when the bounded job queue has no room."""
+
+
+def prompt_hash(prompt):
+    return hashlib.md5(prompt.encode()).hexdigest()
+
+
+class ImageJob:
+    """One image generation for one prompt; shared by every scene that asked for that prompt."""
+
+    def __init__(self, key, prompt):
+        self.key = key
+        self.prompt = prompt
+        self.status = QUEUED
+        self.image_url = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._callbacks = []
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        return {"job_id": self.key, "status": self.status, "image_url": self.image_url}
+
+
+class ImageJobScheduler:
+    """
+    Fixed pool of worker threads draining a bounded queue of image jobs.
+
+    Jobs are keyed by the prompt hash: submitting a prompt that is already queued or
+    running returns the in-flight job instead of starting a second ComfyUI generation.
+    When the queue is full, submit() raises ImageQueueFull so callers can shed load.
+    """
+
+    def __init__(self, generate, workers=2, max_queue=64):
+        self._generate = generate
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = {}  # prompt hash -> ImageJob
+        self._threads = []
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _ensure_workers(self):
+        # Started lazily so importing the app (e.g. the Flask reloader parent) spawns no threads.
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"image-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, prompt, on_done=None):
+        """
+        Queue an image for prompt (or join the identical in-flight job) and return the ImageJob.
+        on_done(job) runs on the worker thread once the job finishes.
+        """
+        key = prompt_hash(prompt)
+        with self._lock:
+            self._ensure_workers()
+            job = self._in_flight.get(key)
+            if job is not None:
+                self.coalesced += 1
+                if on_done:
+                    job._callbacks.append(on_done)
+                return job
+            job = ImageJob(key, prompt)
+            if on_done:
+                job._callbacks.append(on_done)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                job.status = REJECTED
+                job.finished_at = time.monotonic()
+                raise ImageQueueFull(f"image queue is full ({self.max_queue} jobs)")
+            self._in_flight[key] = job
+            self.submitted += 1
+            return job
+
+    def add_done_callback(self, job, callback):
+        """Call callback(job) once job has finished: right away if it already has, else on the worker thread."""
+        with self._lock:
+            if not job.finished:
+                job._callbacks.append(callback)
+                return
+        callback(job)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.monotonic()
+            try:
+                job.image_url = self._generate(job.prompt)
+                job.status = DONE if job.image_url else FAILED
+            except Exception as e:
+                print(f"Error generating image: {e}")
+                job.error = str(e)
+                job.status = FAILED
+            job.finished_at = time.monotonic()
+            with self._lock:
+                self._in_flight.pop(job.key, None)
+                callbacks, job._callbacks = job._callbacks, []
+                if job.status == DONE:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            for callback in callbacks:
+                try:
+                    callback(job)
+                except Exception as e:
+                    print(f"Error in image job callback: {e}")
+            self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._in_flight.values() if job.status == RUNNING)
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queued": self._queue.qsize(),
+                "running": running,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
@@ -0,0 +1,194 @@
+import argparse
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have her his in into is it its of on or over she that the "
+    "their them they this to under up was were with you your".split()
+)
+# A scene with a boy and a dog must not reuse the picture of a girl and a cat, however similar the rest is
+KEY_TERMS = frozenset({"boy", "girl", "dog", "cat"})
+_WORD = re.compile(r"[a-z]+")
+# Candidates come from words in at most this share of the prompts (the style suffix is in all of them)
+CANDIDATE_DF_RATIO = 0.2
+# Stored document weights are recomputed once the index has grown by this fraction (IDF drift)
+REWEIGHT_GROWTH = 0.1
+
+
+def tokenize(text):
+    return [w for w in _WORD.findall(text.lower()) if len(w) > 2 and w not in STOPWORDS]
+
+
+class PromptImageIndex:
+    """
+    TF-IDF index of image prompts -> generated image files, used to reuse the image of a
+    near-duplicate scene instead of running diffusion again.
+
+    Similarity is the cosine of (1 + log tf) * log((N + 1) / df) vectors, so words shared by
+    every prompt (the style suffix) count for almost nothing. Candidates come from an inverted
+    index over the query's uncommon words (df at most CANDIDATE_DF_RATIO of N, else its rarest
+    word) and must have the same KEY_TERMS. Document weights and norms are stored and refreshed
+    when N has grown by REWEIGHT_GROWTH, so a lookup only touches its candidates. Entries are
+    appended to a JSONL file at path and reloaded on start (skipping images no longer on disk).
+    """
+
+    def __init__(self, path=None, threshold=0.8, image_dir=None, key_terms=KEY_TERMS):
+        self.path = path
+        self.threshold = threshold
+        self.image_dir = image_dir or (os.path.dirname(path) if path else None)
+        self.key_terms = key_terms
+        self._lock = threading.Lock()
+        self._docs = []  # {"prompt", "file", "seconds", "tf": Counter, "weights": {term: weight}, "norm"}
+        self._files = set()
+        self._postings = defaultdict(set)  # term -> doc indexes
+        self._df = Counter()
+        self._weighted_docs = 0  # N when all weights were last recomputed
+        self.lookups = 0
+        self.hits = 0
+        self.seconds_saved = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if self._exists(entry["file"]):
+                    self._index(entry["prompt"], entry["file"], entry.get("seconds") or 0.0)
+
+    def _exists(self, filename):
+        return self.image_dir is None or os.path.isfile(os.path.join(self.image_dir, filename))
+
+    def _index(self, prompt, filename, seconds):
+        # Caller holds self._lock (or is __init__)
+        if filename in self._files:
+            return False
+        tf = Counter(tokenize(prompt))
+        doc_id = len(self._docs)
+        doc = {"prompt": prompt, "file": filename, "seconds": seconds, "tf": tf}
+        self._docs.append(doc)
+        self._files.add(filename)
+        for term in tf:
+            self._postings[term].add(doc_id)
+            self._df[term] += 1
+        if len(self._docs) > self._weighted_docs * (1 + REWEIGHT_GROWTH):
+            self._reweight()
+        else:
+            self._weigh(doc)
+        return True
+
+    def _weigh(self, doc):
+        doc["weights"] = self._vector(doc["tf"], len(self._docs))
+        doc["norm"] = math.sqrt(sum(w * w for w in doc["weights"].values()))
+
+    def _reweight(self):
+        # Caller holds self._lock (or is __init__)
+        for doc in self._docs:
+            self._weigh(doc)
+        self._weighted_docs = len(self._docs)
+
+    def add(self, prompt, filename, seconds):
+        """Index a freshly generated image (seconds: how long it took, credited on later reuse)."""
+        with self._lock:
+            if not self._index(prompt, filename, seconds):
+                return
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"prompt": prompt, "file": filename, "seconds": round(seconds, 2)}) + "\n")
+            except OSError as e:
+                print(f"Could not append to prompt index {self.path}: {e}")
+
+    def _vector(self, tf, n_docs):
+        vector = {}
+        for term, count in tf.items():
+            df = self._df.get(term, 0)
+            vector[term] = (1 + math.log(count)) * math.log((n_docs + 1) / df if df else n_docs + 1)
+        return vector
+
+    def _nearest(self, prompt, exclude=None):
+        # Caller holds self._lock; returns (doc, score) of the most similar other prompt or (None, 0.0)
+        tf = Counter(tokenize(prompt))
+        n_docs = len(self._docs)
+        query = self._vector(tf, n_docs)
+        query_norm = math.sqrt(sum(w * w for w in query.values()))
+        if not query_norm:
+            return None, 0.0
+        keys = self.key_terms & tf.keys()
+        indexed = [t for t in query if self._df.get(t)]
+        if not indexed:
+            return None, 0.0
+        uncommon = [t for t in indexed if self._df[t] <= n_docs * CANDIDATE_DF_RATIO]
+        candidates = set()
+        for term in uncommon or [min(indexed, key=self._df.get)]:
+            candidates |= self._postings[term]
+        best, best_score = None, 0.0
+        for doc_id in candidates:
+            doc = self._docs[doc_id]
+            if doc["file"] == exclude or not doc["norm"] or self.key_terms & doc["tf"].keys() != keys:
+                continue
+            weights = doc["weights"]
+            score = sum(w * weights[t] for t, w in query.items() if t in weights) / (query_norm * doc["norm"])
+            if score > best_score:
+                best, best_score = doc, score
+        return best, best_score
+
+    def match(self, prompt):
+        """
+        Filename of an indexed image whose prompt is within the threshold of this one, or None.
+        Counts the lookup; a hit credits the matched image's generation time as saved.
+        """
+        with self._lock:
+            self.lookups += 1
+            doc, score = self._nearest(prompt)
+            if doc is None or score < self.threshold or not self._exists(doc["file"]):
+                return None
+            self.hits += 1
+            self.seconds_saved += doc["seconds"]
+            return doc["file"]
+
+    def nearest_pairs(self):
+        """(prompt, nearest other prompt, score) for every entry, most similar first (threshold tuning)."""
+        with self._lock:
+            pairs = []
+            for doc in self._docs:
+                other, score = self._nearest(doc["prompt"], exclude=doc["file"])
+                if other is not None:
+                    pairs.append((doc["prompt"], other["prompt"], score))
+        return sorted(pairs, key=lambda p: -p[2])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "entries": len(self._docs),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+                "gpu_seconds_saved": round(self.seconds_saved, 1),
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show how a similarity threshold would pair up indexed scene prompts.")
+    parser.add_argument("index", nargs="?", default="static/images/prompt_index.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--margin", type=float, default=0.05, help="also list pairs this far below the threshold")
+    args = parser.parse_args()
+
+    index = PromptImageIndex(args.index, args.threshold)
+    pairs = index.nearest_pairs()
+    reused = [p for p in pairs if p[2] >= args.threshold]
+    print(f"{len(pairs)} prompts; {len(reused)} would reuse their nearest image at threshold {args.threshold}")
+    for prompt, other, score in pairs:
+        if score >= args.threshold - args.margin:
+            mark = "REUSE" if score >= args.threshold else "near "
+            print(f"\n[{mark} {score:.3f}]\n  {prompt[:160]}\n  {other[:160]}")
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ImageResultStore:
+    """
+    Scene-image results keyed by (session key, scene id). A result is whatever the caller
+    records for the scene: the app stores the ImageJob handle, whose status and image_url
+    fill in once the worker finishes.
+
+    Entries expire after ttl_seconds without being read, and the least recently used ones
+    are evicted beyond max_entries, so the store stays bounded under traffic and one player
+    never sees another player's scene. Each entry is a small handle (the image itself lives
+    on disk), so the entry count bounds the memory too.
+    """
+
+    def __init__(self, max_entries=2048, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (session_key, scene_id) -> (result, stored_at)
+        self._by_session = {}  # session_key -> set of scene ids
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        self._entries.pop(key)
+        scenes = self._by_session.get(key[0])
+        if scenes is not None:
+            scenes.discard(key[1])
+            if not scenes:
+                del self._by_session[key[0]]
+
+    def _expire(self, now):
+        # Least recently touched entries sit at the front; put/get move entries to the back.
+        while self._entries:
+            key, (_, stored_at) = next(iter(self._entries.items()))
+            if now - stored_at < self.ttl_seconds:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def put(self, session_key, scene_id, result):
+        """Record the result for a scene."""
+        key = (session_key, scene_id)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, now)
+            self._by_session.setdefault(session_key, set()).add(scene_id)
+            self._expire(now)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get(self, session_key, scene_id):
+        """Return (found, result); found is False when nothing is stored for this scene."""
+        key = (session_key, scene_id)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries[key] = (entry[0], now)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def discard_session(self, session_key):
+        """Drop every stored result for one session (e.g. on /restart)."""
+        with self._lock:
+            for scene_id in list(self._by_session.get(session_key, ())):
+                self._remove((session_key, scene_id))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "sessions": len(self._by_session),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
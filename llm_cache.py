@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(model, options, messages):
+    """Hash of everything that determines a reply: model name, generation options and the message list."""
+    payload = json.dumps({"model": model, "options": options, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Model replies keyed by cache_key(), kept in memory (LRU beyond max_entries) and appended to
+    a JSONL file at path so they survive restarts. Replies older than ttl_seconds are dropped.
+
+    With variants=K each key keeps up to K different replies: the first K requests for a key are
+    misses (each generated reply is added), later ones get one of them at random, so repeated
+    prompts such as openings still vary. A model that answers the same prompt identically every
+    time just ends up with fewer variants. The file is compacted (expired and evicted entries
+    removed) when it is loaded.
+    """
+
+    def __init__(self, path=None, max_entries=1000, ttl_seconds=7 * 24 * 3600, variants=1):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [replies generated, [[text, generation seconds, stored_at], ...]]
+        self.lookups = 0
+        self.hits = 0
+        self.stored = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        now = time.time()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        key, text, seconds, stored_at = entry["key"], entry["text"], entry["seconds"], entry["stored_at"]
+                    except (ValueError, KeyError):
+                        continue
+                    if now - stored_at < self.ttl_seconds:
+                        self._add(key, text, seconds, stored_at)
+        except OSError as e:
+            print(f"LLM cache: ignoring unreadable {self.path}: {e}")
+            return
+        self.stored = self.evictions = 0
+        self._compact()
+
+    def _compact(self):
+        tmp = f"{self.path}.part"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                for key, (_, variants) in self._entries.items():
+                    for text, seconds, stored_at in variants:
+                        f.write(self._line(key, text, seconds, stored_at))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"LLM cache: could not rewrite {self.path}: {e}")
+
+    @staticmethod
+    def _line(key, text, seconds, stored_at):
+        return json.dumps({"key": key, "text": text, "seconds": round(seconds, 2), "stored_at": stored_at}, ensure_ascii=False) + "\n"
+
+    def _add(self, key, text, seconds, stored_at):
+        # Caller holds self._lock (or is _load); returns False if the reply is already stored
+        entry = self._entries.setdefault(key, [0, []])
+        self._entries.move_to_end(key)
+        entry[0] += 1
+        variants = entry[1]
+        for variant in variants:
+            if variant[0] == text:
+                variant[2] = stored_at
+                return False
+        variants.append([text, seconds, stored_at])
+        del variants[: -self.variants]
+        self.stored += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def get(self, key):
+        """A cached reply for key, or None (a miss, also while fewer than variants replies have been generated)."""
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            generated, variants = entry
+            live = [v for v in variants if now - v[2] < self.ttl_seconds]
+            if len(live) < len(variants):
+                self.expirations += len(variants) - len(live)
+                if not live:
+                    del self._entries[key]
+                    return None
+                entry[:] = generated, variants = len(live), live
+            if generated < self.variants:
+                return None
+            self._entries.move_to_end(key)
+            text, seconds, _ = random.choice(variants)
+            self.hits += 1
+            self.seconds_saved += seconds
+            return text
+
+    def put(self, key, text, seconds):
+        """Store a freshly generated reply (seconds: how long it took, credited on later hits)."""
+        if not text:
+            return
+        stored_at = time.time()
+        with self._lock:
+            if not self._add(key, text, seconds, stored_at):
+                return
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(self._line(key, text, seconds, stored_at))
+            except OSError as e:
+                print(f"LLM cache: could not append to {self.path}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "variants": self.variants,
+                "ttl_seconds": self.ttl_seconds,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.lookups, 3) if self.lookups else None,
+                "generation_seconds_saved": round(self.seconds_saved, 1),
+                "stored": self.stored,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,107 @@
+import threading
+from collections import deque
+
+from game.context import message_tokens
+
+NS_PER_MS = 1_000_000
+MODEL_LOAD_MS = 100  # load_duration above this means the model was (re)loaded for the request
+
+
+class OllamaTimings:
+    """
+    Timing stats from the fields Ollama returns with a finished chat (prompt_eval_count and
+    prompt_eval_duration, eval_count and eval_duration, load_duration). prompt_eval_count only
+    counts prompt tokens that were not served from the model's prompt cache, so comparing it to
+    the (estimated) prompt size shows how much of each prompt's prefix was reused.
+    """
+
+    def __init__(self, recent=50, log=False):
+        self.log = log
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=recent)
+        self.requests = 0
+        self.model_loads = 0
+        self.prompt_tokens = 0
+        self.prompt_evaluated = 0
+        self.prompt_eval_ms = 0.0
+        self.eval_tokens = 0
+        self.eval_ms = 0.0
+
+    def record(self, response, messages):
+        """Record one finished chat: response is the non-streamed reply or the final (done) chunk."""
+        entry = {
+            "prompt_tokens": sum(message_tokens(m) for m in messages),
+            "prompt_evaluated": response.get("prompt_eval_count") or 0,
+            "prompt_eval_ms": round((response.get("prompt_eval_duration") or 0) / NS_PER_MS, 1),
+            "eval_tokens": response.get("eval_count") or 0,
+            "eval_ms": round((response.get("eval_duration") or 0) / NS_PER_MS, 1),
+            "load_ms": round((response.get("load_duration") or 0) / NS_PER_MS, 1),
+        }
+        with self._lock:
+            self._recent.append(entry)
+            self.requests += 1
+            self.model_loads += entry["load_ms"] > MODEL_LOAD_MS
+            self.prompt_tokens += entry["prompt_tokens"]
+            self.prompt_evaluated += entry["prompt_evaluated"]
+            self.prompt_eval_ms += entry["prompt_eval_ms"]
+            self.eval_tokens += entry["eval_tokens"]
+            self.eval_ms += entry["eval_ms"]
+        if self.log:
+            print(
+                f"Ollama: prompt ~{entry['prompt_tokens']} tok ({entry['prompt_evaluated']} evaluated) "
+                f"{entry['prompt_eval_ms']:.0f} ms, reply {entry['eval_tokens']} tok {entry['eval_ms']:.0f} ms, "
+                f"load {entry['load_ms']:.0f} ms"
+            )
+
+    def stats(self):
+        with self._lock:
+            n = self.requests
+            return {
+                "requests": n,
+                "model_loads": self.model_loads,
+                "prompt_tokens_avg": round(self.prompt_tokens / n) if n else None,
+                "prompt_evaluated_avg": round(self.prompt_evaluated / n) if n else None,
+                # Share of prompt tokens Ollama did not have to evaluate (estimate: prompt sizes are estimated)
+                "prompt_reuse": round(max(0.0, 1 - self.prompt_evaluated / self.prompt_tokens), 3) if self.prompt_tokens else None,
+                "prompt_eval_ms_avg": round(self.prompt_eval_ms / n, 1) if n else None,
+                "eval_ms_avg": round(self.eval_ms / n, 1) if n else None,
+                "eval_tokens_per_s": round(self.eval_tokens / (self.eval_ms / 1000), 1) if self.eval_ms else None,
+                "recent": list(self._recent),
+            }
+
+
+class SceneFormatStats:
+    """
+    How usable the storyteller's replies were, per output mode: "text" (numbered options and a
+    Chapter: line found with regexes) or "json" (structured replies). A reply with no scene text or
+    no options is unusable: the player would need that turn generated again. For json, also counts
+    replies cut off and completed by the tolerant parser ("repaired") and ones that were not JSON
+    and went through the text parser ("fallback").
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def record(self, mode, parsed, how=None):
+        """parsed: game.engine.ParsedScene of the reply as stored; how: structured_reply_text's status."""
+        with self._lock:
+            counts = self._modes.setdefault(mode, {"replies": 0, "unusable": 0, "no_chapter": 0})
+            counts["replies"] += 1
+            counts["unusable"] += not parsed.scene_text or not parsed.options
+            counts["no_chapter"] += parsed.chapter_title is None
+            if how is not None:
+                counts[how] = counts.get(how, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            modes = {mode: dict(counts) for mode, counts in self._modes.items()}
+        for counts in modes.values():
+            counts["unusable_rate"] = round(counts["unusable"] / counts["replies"], 3)
+        text, structured = modes.get("text"), modes.get("json")
+        if text and structured:
+            # Regenerations the json replies would have needed at the text mode's failure rate, minus those they did need
+            modes["regenerations_avoided"] = round(
+                structured["replies"] * text["unusable"] / text["replies"] - structured["unusable"], 1
+            )
+        return modes
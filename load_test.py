@@ -0,0 +1,224 @@
+"""
+Load test for the game server: many simulated players opening a game and making choices.
+
+Compare the serving modes against the same (fake) storyteller so only the server differs:
+
+    python load_test.py mock-ollama --port 11435 --delay 2
+    export OLLAMA_HOST=127.0.0.1:11435 FABLES_LLM_CONCURRENCY=0
+    waitress-serve --threads 8 --port 5000 app:app   (threaded WSGI)
+    uvicorn asgi_app:app --port 5001                 (ASGI)
+    python load_test.py run --url http://127.0.0.1:5000 --url http://127.0.0.1:5001 --players 200
+
+FABLES_LLM_CONCURRENCY=0 lifts the server's model-call admission limit (by default 4 calls per
+Ollama host and 16 waiting), which would otherwise answer most of 200 players with 429 in both
+modes. With the limit on, players wait Retry-After and resubmit like the game page does; those
+429s are reported as "busy", apart from errors, and latencies include the time waited.
+
+The server can also spread calls over several mock servers (FABLES_OLLAMA_HOSTS=http://127.0.0.1:11435,
+http://127.0.0.1:11436) or skip the mock entirely (FABLES_LLM_BACKEND=fake FABLES_FAKE_LLM_DELAY=2).
+
+Each player is its own cookie jar: one opening scene (GET /), then --turns choices
+(POST /make_choice or, with --stream, /make_choice_stream). Reports latency percentiles,
+throughput and errors per URL.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+MAX_BUSY_RETRIES = 50  # 429 answers a player waits out per request before counting it as an error
+
+MOCK_SCENE = (
+    "A little fox waves hello from a sunny meadow. Birds sing in the tall green grass, "
+    "and a soft wind carries the smell of flowers. Your friend wags happily beside you.\n\n"
+    "1. Follow the fox to the stream\n2. Pick some flowers\n3. Climb the little hill\n\n"
+    "Chapter: The sunny meadow"
+)
+
+
+# === Fake Ollama ===
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """Answers /api/chat after a fixed delay, streamed (NDJSON) or not, like Ollama."""
+
+    delay = 2.0
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Health checks (the LLM pool pings /api/ps)
+        if self.path not in ("/api/ps", "/api/version"):
+            self.send_error(404)
+            return
+        payload = json.dumps({"models": []} if self.path == "/api/ps" else {"version": "mock"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/api/chat":
+            self.send_error(404)
+            return
+        time.sleep(self.delay)
+        model = body.get("model", "")
+        if body.get("stream", True):
+            words = MOCK_SCENE.split(" ")
+            lines = [
+                {"model": model, "message": {"role": "assistant", "content": w + " "}, "done": False}
+                for w in words
+            ]
+            lines.append({"model": model, "message": {"role": "assistant", "content": ""}, "done": True})
+            payload = "".join(json.dumps(line) + "\n" for line in lines).encode()
+            content_type = "application/x-ndjson"
+        else:
+            payload = json.dumps(
+                {"model": model, "message": {"role": "assistant", "content": MOCK_SCENE}, "done": True}
+            ).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_mock_ollama(port, delay):
+    MockOllamaHandler.delay = delay
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockOllamaHandler)
+    server.daemon_threads = True
+    print(f"Mock Ollama on http://127.0.0.1:{port} ({delay}s per reply)")
+    server.serve_forever()
+
+
+# === Simulated players ===
+def _retry_after(response):
+    try:
+        return max(0.1, float(response.headers.get("Retry-After", "1")))
+    except ValueError:
+        return 1.0
+
+
+async def _turn_once(client, body, stream, t0, results):
+    """One turn request: (response, turn number from the reply or None, completed)."""
+    if not stream:
+        r = await client.post("/make_choice", json=body)
+        if r.status_code != 200:
+            return r, None, False
+        return r, r.json().get("turn"), True
+    async with client.stream("POST", "/make_choice_stream", json=body) as r:
+        if r.status_code != 200:
+            await r.aread()
+            return r, None, False
+        first = None
+        done = None
+        turn = None
+        async for line in r.aiter_lines():
+            if first is None and line.startswith("event: token"):
+                first = time.perf_counter() - t0
+            if line.startswith("data: ") and done == "pending":
+                turn = json.loads(line[6:]).get("turn")
+                done = "ok"
+            if line == "event: done":
+                done = "pending"
+        if first is not None:
+            results["first_token"].append(first)
+        return r, turn, done == "ok"
+
+
+async def play(base_url, turns, stream, timeout, results):
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+        t0 = time.perf_counter()
+        try:
+            for _ in range(MAX_BUSY_RETRIES + 1):
+                r = await client.get("/", params={"start": "forest", "character": "boy", "companion": "dog"})
+                if r.status_code != 429:
+                    break
+                results["busy"].append(_retry_after(r))
+                await asyncio.sleep(_retry_after(r))
+            results["opening"].append(time.perf_counter() - t0)
+            if r.status_code != 200:
+                results["errors"].append(f"GET / -> {r.status_code}")
+                return
+        except httpx.HTTPError as e:
+            results["errors"].append(f"GET / -> {type(e).__name__}")
+            return
+        turn = None
+        for _ in range(turns):
+            t0 = time.perf_counter()
+            body = {"choice": 1} if turn is None else {"choice": 1, "turn": turn}
+            try:
+                for _ in range(MAX_BUSY_RETRIES + 1):
+                    r, next_turn, ok = await _turn_once(client, body, stream, t0, results)
+                    if r.status_code != 429:
+                        break
+                    results["busy"].append(_retry_after(r))
+                    await asyncio.sleep(_retry_after(r))
+            except httpx.HTTPError as e:
+                results["errors"].append(f"turn -> {type(e).__name__}")
+                return
+            results["turn"].append(time.perf_counter() - t0)
+            if not ok:
+                results["errors"].append(f"turn -> {r.status_code}")
+                return
+            turn = next_turn
+
+
+def _percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return f"p50 {pick(0.5):.2f}s  p95 {pick(0.95):.2f}s  max {values[-1]:.2f}s  mean {statistics.mean(values):.2f}s"
+
+
+async def run_load(base_url, players, turns, stream, ramp, timeout):
+    results = {"opening": [], "turn": [], "first_token": [], "busy": [], "errors": []}
+    started = time.perf_counter()
+    tasks = []
+    for i in range(players):
+        tasks.append(asyncio.create_task(play(base_url, turns, stream, timeout, results)))
+        if ramp:
+            await asyncio.sleep(ramp / players)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    requests = len(results["opening"]) + len(results["turn"])
+    print(f"\n{base_url}: {players} players x (1 opening + {turns} turns), {elapsed:.1f}s wall")
+    print(f"  throughput  {requests / elapsed:.1f} req/s")
+    print(f"  opening     {_percentiles(results['opening'])}")
+    print(f"  turn        {_percentiles(results['turn'])}")
+    if stream:
+        print(f"  1st token   {_percentiles(results['first_token'])}")
+    print(f"  busy (429)  {len(results['busy'])}" + (f", {sum(results['busy']):.0f}s waited" if results["busy"] else ""))
+    print(f"  errors      {len(results['errors'])}" + (f" (e.g. {results['errors'][0]})" if results["errors"] else ""))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the game server (threaded WSGI vs ASGI).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mock = sub.add_parser("mock-ollama", help="run a fake Ollama /api/chat with a fixed reply delay")
+    mock.add_argument("--port", type=int, default=11435)
+    mock.add_argument("--delay", type=float, default=2.0, help="seconds per reply")
+    run = sub.add_parser("run", help="simulate players against one or more server URLs")
+    run.add_argument("--url", action="append", required=True, help="server base URL (repeat to compare)")
+    run.add_argument("--players", type=int, default=100)
+    run.add_argument("--turns", type=int, default=2)
+    run.add_argument("--stream", action="store_true", help="use /make_choice_stream")
+    run.add_argument("--ramp", type=float, default=0.0, help="seconds over which players join")
+    run.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    if args.command == "mock-ollama":
+        run_mock_ollama(args.port, args.delay)
+    else:
+        for url in args.url:
+            asyncio.run(run_load(url.rstrip("/"), args.players, args.turns, args.stream, args.ramp, args.timeout))
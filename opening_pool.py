@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+def _messages_hash(messages):
+    return hashlib.md5(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+
+
+class OpeningPool:
+    """
+    Warm pool of pre-written opening scenes: up to per_combo per setup (start x character x
+    companion), each used by one new game only so players get variety. A single background
+    thread refills whichever setup has the fewest openings, one at a time, so it never
+    competes with players for more than one model (and, via warm, one image) slot.
+
+    requests maps a setup key to the opening messages sent to the model. The pool is saved
+    to path (if given) after every change; saved openings whose messages have changed since
+    (e.g. an edited system prompt) are dropped on load.
+    """
+
+    def __init__(self, generate, requests, per_combo=2, warm=None, path=None, retry_delay=30):
+        self._generate = generate
+        self._requests = dict(requests)
+        self._hashes = {key: _messages_hash(messages) for key, messages in self._requests.items()}
+        self.per_combo = per_combo
+        self._warm = warm
+        self.path = path
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pool = {key: deque() for key in self._requests}
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.failures = 0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Opening pool: ignoring unreadable {self.path}: {e}")
+            return
+        for key, entry in saved.items():
+            if key in self._pool and entry.get("hash") == self._hashes[key]:
+                self._pool[key].extend(entry.get("texts", [])[: self.per_combo])
+
+    def _save(self):
+        # Caller holds self._lock
+        if not self.path:
+            return
+        data = {key: {"hash": self._hashes[key], "texts": list(texts)} for key, texts in self._pool.items()}
+        tmp = f"{self.path}.part"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Opening pool: could not save {self.path}: {e}")
+
+    def start(self):
+        """Start the refill thread (idempotent; started lazily so importing the app spawns no threads)."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._fill, name="opening-pool", daemon=True)
+                self._thread.start()
+
+    def take(self, key):
+        """A pre-written opening for the setup (removed from the pool and refilled later), or None."""
+        self.start()
+        with self._lock:
+            texts = self._pool.get(key)
+            if not texts:
+                self.misses += 1
+                return None
+            text = texts.popleft()
+            self.hits += 1
+            self._save()
+        self._wakeup.set()
+        return text
+
+    def _next_key(self):
+        with self._lock:
+            key = min(self._pool, key=lambda k: len(self._pool[k]), default=None)
+            if key is None or len(self._pool[key]) >= self.per_combo:
+                return None
+            return key
+
+    def _fill(self):
+        delay = self.retry_delay
+        while True:
+            key = self._next_key()
+            if key is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                text = self._generate(self._requests[key])
+            except Exception as e:
+                self.failures += 1
+                print(f"Opening pool: generating '{key}' failed ({e}); retrying in {delay}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 600)
+                continue
+            delay = self.retry_delay
+            if self._warm:
+                try:
+                    self._warm(text)
+                except Exception as e:
+                    print(f"Opening pool: warming '{key}' failed: {e}")
+            with self._lock:
+                self._pool[key].append(text)
+                self.fills += 1
+                self._save()
+
+    def stats(self):
+        with self._lock:
+            sizes = [len(texts) for texts in self._pool.values()]
+            served = self.hits + self.misses
+            return {
+                "per_combo": self.per_combo,
+                "combos": len(sizes),
+                "ready": sum(sizes),
+                "empty_combos": sum(1 for n in sizes if n == 0),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / served, 3) if served else None,
+                "fills": self.fills,
+                "failures": self.failures,
+            }
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+
+QUEUED = "queued"
+DONE = "done"
+FAILED = "failed"
+
+
+class RunJournal:
+    """
+    Append-only JSONL journal of a batch generation run, one record per state change:
+    {"key", "state": queued|done|failed, "output", "elapsed", "attempt", "error", "ts"}.
+
+    Replaying the file on open gives the latest state per key, so a rerun can skip work
+    that is already done (without asking ComfyUI) and retry only failures, up to
+    max_retries attempts per key. A key left 'queued' by an interrupted run counts as a
+    failed attempt.
+    """
+
+    def __init__(self, path, max_retries=3):
+        self.path = path
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._latest = {}  # key -> last record
+        self._attempts = {}  # key -> number of times it was queued
+        self._started = {}  # key -> time.time() when last queued in this process
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                self._apply(record)
+
+    def _apply(self, record):
+        key = record["key"]
+        self._latest[key] = record
+        if record["state"] == QUEUED:
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+
+    def _append(self, record):
+        record["ts"] = time.time()
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+            self._apply(record)
+
+    def state(self, key):
+        record = self._latest.get(key)
+        return record["state"] if record else None
+
+    def output(self, key):
+        record = self._latest.get(key)
+        return record.get("output") if record else None
+
+    def attempts(self, key):
+        return self._attempts.get(key, 0)
+
+    def is_done(self, key):
+        """Done in a previous or this run, and the recorded output is still on disk (if local)."""
+        record = self._latest.get(key)
+        if not record or record["state"] != DONE:
+            return False
+        local_path = record.get("local_path")
+        return not local_path or os.path.exists(local_path)
+
+    def should_run(self, key):
+        """True for new keys and for unfinished/failed keys with retries left."""
+        if self.is_done(key):
+            return False
+        return self.attempts(key) < self.max_retries
+
+    def mark_queued(self, key):
+        self._started[key] = time.time()
+        self._append({"key": key, "state": QUEUED, "attempt": self.attempts(key) + 1})
+
+    def mark_done(self, key, output, local_path=None):
+        self._append({
+            "key": key,
+            "state": DONE,
+            "output": output,
+            "local_path": local_path,
+            "elapsed": self._elapsed(key),
+            "attempt": self.attempts(key),
+        })
+
+    def mark_failed(self, key, error=None):
+        self._append({
+            "key": key,
+            "state": FAILED,
+            "error": error,
+            "elapsed": self._elapsed(key),
+            "attempt": self.attempts(key),
+        })
+
+    def _elapsed(self, key):
+        started = self._started.pop(key, None)
+        return round(time.time() - started, 3) if started else None
+
+    def summary(self):
+        counts = {QUEUED: 0, DONE: 0, FAILED: 0}
+        for record in self._latest.values():
+            counts[record["state"]] += 1
+        exhausted = sum(
+            1 for key, record in self._latest.items()
+            if record["state"] != DONE and self.attempts(key) >= self.max_retries
+        )
+        return {**counts, "retries_exhausted": exhausted}
@@ -0,0 +1,43 @@
+import threading
+
+
+class SessionLocks:
+    """
+    One lock per game session, created on demand and dropped when nobody holds or waits
+    for it, so requests for the same game are serialized without a global lock that every
+    player contends on. Locks are per process.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # key -> [lock, holders + waiters]
+        self.busy_rejections = 0
+
+    def _unref(self, key, entry):
+        with self._guard:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def acquire(self, key, blocking=True, timeout=-1):
+        """Take the session's lock; with blocking=False returns False at once if it is held."""
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        if entry[0].acquire(blocking, timeout):
+            return True
+        self._unref(key, entry)
+        self.busy_rejections += 1
+        return False
+
+    def release(self, key):
+        with self._guard:
+            entry = self._locks[key]
+        entry[0].release()
+        self._unref(key, entry)
+
+    def stats(self):
+        with self._guard:
+            return {"sessions_locked": len(self._locks), "busy_rejections": self.busy_rejections}
@@ -0,0 +1,248 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+USED = "used"
+WASTED = "wasted"
+
+
+class Branch:
+    """The speculative reply to one offered option, generated in the background."""
+
+    def __init__(self, player_text):
+        self.player_text = player_text
+        self.text = None  # full reply once generated; stays None if it failed or was cancelled
+        self.error = None
+        self.elapsed = 0.0
+        self.image_queued = False
+        self.outcome = None  # USED / WASTED once the player has chosen
+        self.future = None
+        self._cancelled = threading.Event()
+        self._running = False
+        self._done = threading.Event()
+        self._finished = False
+        self._settled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def begin(self):
+        """Called when the model call starts (it may first wait for a slot); False if cancelled meanwhile."""
+        with self._lock:
+            if self._cancelled.is_set():
+                return False
+            self._running = True
+            return True
+
+    def cancel(self):
+        """Stop generating at the next streamed chunk (e.g. a player gave up waiting on it)."""
+        self._cancelled.set()
+
+    def _cancel_unless_running(self):
+        # True if the branch is being generated or finished; otherwise it is cancelled and never starts
+        with self._lock:
+            if self._running or self._done.is_set():
+                return True
+            self._cancelled.set()
+            return False
+
+    def result(self, timeout=None):
+        """Wait for the reply; None if generation failed, was cancelled or timed out."""
+        self._done.wait(timeout)
+        return self.text
+
+    def add_done_callback(self, callback):
+        """Call callback(branch) once it has finished: right away if it already has, else on the worker thread."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Error in speculative branch callback: {e}")
+
+
+class Speculator:
+    """
+    Speculative turns: after a scene is shown, generate the reply to each offered option on a
+    small worker pool so that whichever the player picks is already written (or under way).
+
+    start() replaces a session's branches; take() hands over the branch matching the player's
+    message and cancels the rest. A cancelled branch that has not started never runs; one that
+    is generating stops at its next streamed chunk, which closes the request to the model.
+    generate_stream(messages, begin) must call begin() once its model call starts and give up
+    if it returns False: a branch still waiting for a model slot is not handed over (the turn
+    would wait behind background work), it is cancelled and the turn is generated directly.
+    Budget: at most max_branches per turn and max_pending branches queued or running overall
+    (beyond that speculation is skipped), state for at most max_sessions sessions.
+    """
+
+    def __init__(self, generate_stream, on_ready=None, workers=2, max_branches=3, max_pending=8, max_sessions=256):
+        self._generate_stream = generate_stream
+        self._on_ready = on_ready
+        self.workers = workers
+        self.max_branches = max_branches
+        self.max_pending = max_pending
+        self.max_sessions = max_sessions
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculate")
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session key -> (turn, {player text: Branch})
+        self._pending = 0
+        self.started = 0
+        self.skipped = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.not_started = 0
+        self.wasted = 0
+        self.cancelled_before_start = 0
+        self.images_queued = 0
+        self.used_seconds = 0.0
+        self.wasted_seconds = 0.0
+
+    def start(self, key, turn, requests):
+        """
+        Speculate the replies for a session's turn. requests: {player text: messages to send},
+        one entry per offered option; turn: history length the player's choice will answer.
+        """
+        with self._lock:
+            previous = self._sessions.pop(key, None)
+            if previous:
+                self._waste(previous[1].values())
+            branches = {}
+            for player_text, messages in list(requests.items())[: self.max_branches]:
+                if self._pending >= self.max_pending:
+                    self.skipped += 1
+                    continue
+                branch = Branch(player_text)
+                self._pending += 1
+                self.started += 1
+                branch.future = self._pool.submit(self._run, branch, messages)
+                branches[player_text] = branch
+            self._sessions[key] = (turn, branches)
+            while len(self._sessions) > self.max_sessions:
+                _, (_, evicted) = self._sessions.popitem(last=False)
+                self._waste(evicted.values())
+
+    def take(self, key, turn, player_text):
+        """
+        The branch speculated for exactly this turn and player message, or None (a miss).
+        Every other branch of the session is cancelled. The branch may still be generating;
+        one that has not started generating yet is cancelled too and counts as a miss.
+        """
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            if entry is None:
+                return None
+            spec_turn, branches = entry
+            branch = branches.pop(player_text, None) if spec_turn == turn else None
+            self._waste(branches.values())
+            if branch is not None and not branch._cancel_unless_running():
+                self.not_started += 1
+                self.misses += 1
+                self._waste([branch])
+                return None
+            if branch is None or (branch.done and branch.text is None):
+                self.misses += 1
+                if branch is not None:
+                    self._waste([branch])
+                return None
+            if branch.done:
+                self.hits += 1
+            else:
+                self.partial_hits += 1
+            branch.outcome = USED
+            self._settle(branch)
+            return branch
+
+    def discard(self, key):
+        """Cancel a session's branches (game restarted or ended)."""
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            if entry:
+                self._waste(entry[1].values())
+
+    def _waste(self, branches):
+        # Caller holds self._lock
+        for branch in branches:
+            branch.outcome = WASTED
+            branch._cancelled.set()
+            self.wasted += 1
+            if branch.future.cancel():
+                # Never started: no model time spent
+                self._pending -= 1
+                self.cancelled_before_start += 1
+                branch._finished = True
+                branch._finish()
+            self._settle(branch)
+
+    def _settle(self, branch):
+        # Caller holds self._lock; adds the branch's model time once it is both finished and decided
+        if branch._settled or not branch._finished or branch.outcome is None:
+            return
+        branch._settled = True
+        if branch.outcome == USED:
+            self.used_seconds += branch.elapsed
+        else:
+            self.wasted_seconds += branch.elapsed
+
+    def _run(self, branch, messages):
+        started = time.monotonic()
+        parts = []
+        try:
+            for delta in self._generate_stream(messages, branch.begin):
+                if branch._cancelled.is_set():
+                    break
+                parts.append(delta)
+            else:
+                branch.text = "".join(parts)
+        except Exception as e:
+            print(f"Speculative turn failed: {e}")
+            branch.error = str(e)
+        branch.elapsed = time.monotonic() - started
+        if branch.text and self._on_ready and not branch._cancelled.is_set():
+            try:
+                branch.image_queued = bool(self._on_ready(branch))
+            except Exception as e:
+                print(f"Error in speculative branch hook: {e}")
+        with self._lock:
+            self._pending -= 1
+            if branch.image_queued:
+                self.images_queued += 1
+            branch._finished = True
+            self._settle(branch)
+        branch._finish()
+
+    def stats(self):
+        with self._lock:
+            picked = self.hits + self.partial_hits
+            decided = picked + self.misses
+            return {
+                "workers": self.workers,
+                "pending": self._pending,
+                "sessions": len(self._sessions),
+                "branches_started": self.started,
+                "skipped_over_budget": self.skipped,
+                "hits": self.hits,
+                "partial_hits": self.partial_hits,
+                "misses": self.misses,
+                "misses_not_started": self.not_started,
+                "hit_rate": round(picked / decided, 3) if decided else None,
+                "branches_wasted": self.wasted,
+                "cancelled_before_start": self.cancelled_before_start,
+                "images_queued": self.images_queued,
+                "used_seconds": round(self.used_seconds, 2),
+                "wasted_seconds": round(self.wasted_seconds, 2),
+            }
@@ -0,0 +1,210 @@
+import glob
+import json
+import os
+
+# Workflow JSON for fables / storybook scene generation (ComfyUI API format)
+FABLES_WORKFLOW_JSON = '''{
+  "7": {
+    "inputs": {
+      "seed": 0,
+      "steps": 35,
+      "cfg": 8,
+      "sampler_name": "euler",
+      "scheduler": "simple",
+      "denoise": 1,
+      "model": ["20", 0],
+      "positive": ["15", 0],
+      "negative": ["16", 0],
+      "latent_image": ["9", 0]
+    },
+    "class_type": "KSampler",
+    "_meta": {"title": "KSampler"}
+  },
+  "9": {
+    "inputs": {
+      "width": 1280,
+      "height": 1280,
+      "batch_size": 1
+    },
+    "class_type": "EmptyLatentImage",
+    "_meta": {"title": "Empty Latent Image"}
+  },
+  "12": {
+    "inputs": {
+      "samples": ["7", 0],
+      "vae": ["20", 2]
+    },
+    "class_type": "VAEDecode",
+    "_meta": {"title": "VAE Decode"}
+  },
+  "15": {
+    "inputs": {
+      "text": "",
+      "clip": ["20", 1]
+    },
+    "class_type": "CLIPTextEncode",
+    "_meta": {"title": "CLIP Text Encode (Positive Prompt)"}
+  },
+  "16": {
+    "inputs": {
+      "text": "",
+      "clip": ["20", 1]
+    },
+    "class_type": "CLIPTextEncode",
+    "_meta": {"title": "CLIP Text Encode (Negative Prompt)"}
+  },
+  "17": {
+    "inputs": {
+      "filename_prefix": "ComfyUI",
+      "images": ["12", 0]
+    },
+    "class_type": "SaveImage",
+    "_meta": {"title": "Save Image"}
+  },
+  "18": {
+    "inputs": {
+      "images": ["12", 0]
+    },
+    "class_type": "PreviewImage",
+    "_meta": {"title": "Preview Image"}
+  },
+  "20": {
+    "inputs": {
+      "ckpt_name": "anything-v5.safetensors"
+    },
+    "class_type": "CheckpointLoaderSimple",
+    "_meta": {"title": "Load Checkpoint"}
+  }
+}'''
+
+DEFAULT_NEGATIVE_PROMPT = "blurry, low quality, text, watermark, bad anatomy, modern objects, contemporary items"
+
+# Per-request cost profiles: resolution and sampler steps. "quality" matches the original
+# hard-coded workflow; "fast" trades detail for latency (in-game); "batch" is for offline runs.
+COST_PROFILES = {
+    "quality": {"width": 1280, "height": 1280, "steps": 35},
+    "fast": {"width": 768, "height": 768, "steps": 20},
+    "batch": {"width": 1280, "height": 1280, "steps": 35},
+}
+
+# User-supplied workflows (ComfyUI "Save (API Format)" exports) are loaded from here at startup.
+WORKFLOW_DIR = os.environ.get(
+    "FABLES_WORKFLOW_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows")
+)
+
+
+class WorkflowError(ValueError):
+    """Raised when a workflow graph is missing the nodes image generation needs."""
+
+
+def _linked_node(graph, node_id, input_name):
+    """Node id an input is wired to (ComfyUI links are [node_id, output_index])."""
+    value = graph[node_id]["inputs"].get(input_name)
+    if isinstance(value, list) and value:
+        return str(value[0])
+    return None
+
+
+class WorkflowTemplate:
+    """
+    A ComfyUI API-format graph parsed and validated once, with the node ids of the parts
+    that change per request (prompts, seed, size, steps, output prefix).
+
+    build() returns a request-ready graph that shares every unpatched node with the template
+    (copy-on-write); callers must treat the returned graph as read-only apart from build().
+    """
+
+    def __init__(self, name, graph, negative_prompt=DEFAULT_NEGATIVE_PROMPT):
+        self.name = name
+        self.graph = graph
+        self.negative_prompt = negative_prompt
+        self._find_nodes()
+
+    def _find_nodes(self):
+        graph = self.graph
+        if not isinstance(graph, dict) or not graph:
+            raise WorkflowError(f"workflow '{self.name}': expected a non-empty API-format node map")
+        for node_id, node in graph.items():
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise WorkflowError(f"workflow '{self.name}': node {node_id} has no class_type/inputs")
+            for input_name, value in node["inputs"].items():
+                if isinstance(value, list) and value and str(value[0]) not in graph:
+                    raise WorkflowError(
+                        f"workflow '{self.name}': node {node_id} input '{input_name}' links to missing node {value[0]}"
+                    )
+
+        samplers = [nid for nid, node in graph.items() if node["class_type"] in ("KSampler", "KSamplerAdvanced")]
+        saves = [nid for nid, node in graph.items() if node["class_type"] == "SaveImage"]
+        if len(samplers) != 1 or len(saves) != 1:
+            raise WorkflowError(f"workflow '{self.name}': need exactly one KSampler and one SaveImage node")
+        self.sampler_node = samplers[0]
+        self.save_node = saves[0]
+        self.positive_node = _linked_node(graph, self.sampler_node, "positive")
+        self.negative_node = _linked_node(graph, self.sampler_node, "negative")
+        self.latent_node = _linked_node(graph, self.sampler_node, "latent_image")
+        for role, node_id, class_type in (
+            ("positive prompt", self.positive_node, "CLIPTextEncode"),
+            ("negative prompt", self.negative_node, "CLIPTextEncode"),
+            ("latent image", self.latent_node, "EmptyLatentImage"),
+        ):
+            if node_id is None or graph[node_id]["class_type"] != class_type:
+                raise WorkflowError(f"workflow '{self.name}': {role} is not wired to a {class_type} node")
+
+    def build(self, prompt, seed, filename_prefix, negative_prompt=None, profile=None,
+              width=None, height=None, steps=None, batch_size=None):
+        """Graph for one request. Explicit width/height/steps override the cost profile."""
+        settings = dict(COST_PROFILES[profile]) if profile else {}
+        for key, value in (("width", width), ("height", height), ("steps", steps), ("batch_size", batch_size)):
+            if value is not None:
+                settings[key] = value
+
+        graph = dict(self.graph)
+
+        def patch(node_id, **inputs):
+            node = dict(graph[node_id])
+            node["inputs"] = {**node["inputs"], **inputs}
+            graph[node_id] = node
+
+        patch(self.positive_node, text=prompt.strip())
+        patch(self.negative_node, text=negative_prompt if negative_prompt is not None else self.negative_prompt)
+        patch(self.save_node, filename_prefix=filename_prefix)
+        sampler = {"seed": seed}
+        if "steps" in settings:
+            sampler["steps"] = settings["steps"]
+        patch(self.sampler_node, **sampler)
+        latent = {k: settings[k] for k in ("width", "height", "batch_size") if k in settings}
+        if latent:
+            patch(self.latent_node, **latent)
+        return graph
+
+
+def _load_user_workflows(templates):
+    for path in sorted(glob.glob(os.path.join(WORKFLOW_DIR, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(path, encoding="utf-8") as f:
+                templates[name] = WorkflowTemplate(name, json.load(f))
+            print(f"Loaded workflow '{name}' from {path}")
+        except (OSError, ValueError) as e:
+            print(f"Skipping workflow {path}: {e}")
+
+
+def _load_templates():
+    fables = json.loads(FABLES_WORKFLOW_JSON)
+    templates = {
+        "fables": WorkflowTemplate("fables", fables),
+        # MMO batch art runs on the same graph; kept separate so it can diverge (or be overridden by workflows/mmo.json)
+        "mmo": WorkflowTemplate("mmo", fables),
+    }
+    _load_user_workflows(templates)
+    return templates
+
+
+WORKFLOWS = _load_templates()
+
+
+def get_workflow(name):
+    try:
+        return WORKFLOWS[name]
+    except KeyError:
+        raise WorkflowError(f"unknown workflow '{name}' (available: {', '.join(sorted(WORKFLOWS))})") from None